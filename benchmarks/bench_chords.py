@@ -0,0 +1,99 @@
+"""Compare get_chords using the memoized chord shapes with the former nested loops.
+
+Run with: python -m benchmarks.bench_chords
+"""
+import random
+import timeit
+
+from freetar import ug
+from benchmarks.fixtures import tab_pages
+
+
+def legacy_get_chords(s):
+    """get_chords before chord_shape"""
+    if s.appliciture is None:
+        return dict(), dict()
+    chords = {}
+    fingerings = {}
+    for chord in s.appliciture:
+        for chord_variant in s.appliciture[chord]:
+            frets = chord_variant["frets"]
+            min_fret = min(frets)
+            max_fret = max(frets)
+            possible_frets = list(range(min_fret, max_fret+1))
+            variants_temp = {
+                possible_fret: [1 if b == possible_fret else 0 for b in frets][::-1]
+                for possible_fret
+                in possible_frets
+                if possible_fret > 0
+            }
+            variants = dict()
+            found = False
+            for fret, fingers in variants_temp.items():
+                try:
+                    if not found and fingers.index(1) >= 0:
+                        found = True
+                except ValueError:
+                    ...
+                if found:
+                    variants[fret] = fingers
+            if not len(variants):
+                continue
+            while len(variants) < 6:
+                variants[max(variants) + 1] = [0] * 6
+            variant_strings_pressed = [*variants.values()]
+            variant_strings_pressed = [sum(x) for x in zip(*variant_strings_pressed)]
+            unstrummed_strings = [int(not bool(y)) for y in variant_strings_pressed]
+            fingering_for_variant = []
+            for finger, x in zip(chord_variant["fingers"][::-1], unstrummed_strings):
+                fingering_for_variant.append("x" if x else finger)
+            if chord not in chords:
+                chords[chord] = []
+                fingerings[chord] = []
+            chords[chord].append(variants)
+            fingerings[chord].append(fingering_for_variant)
+    return chords, fingerings
+
+
+class _Song:
+    def __init__(self, appliciture):
+        self.appliciture = appliciture
+
+
+def corpus() -> list:
+    """applicature blobs of the fixture tabs"""
+    return [ug.extract_store(page)["store"]["page"]["data"]["tab_view"]["applicature"] for page in tab_pages()]
+
+
+def random_applicature(rnd: random.Random) -> dict:
+    def variant():
+        strings = rnd.choice((4, 6, 6, 6, 7))
+        base = rnd.randint(0, 12)
+        return {"frets": [rnd.choice((-1, 0, base, base + 1, base + 2, base + 3, base + 7)) for _ in range(strings)],
+                "fingers": [rnd.randint(0, 4) for _ in range(rnd.choice((strings, 6)))]}
+    return {f"C{i}": [variant() for _ in range(rnd.randint(1, 3))] for i in range(rnd.randint(1, 8))}
+
+
+def check_identical(samples: int = 5000, seed: int = 0):
+    rnd = random.Random(seed)
+    for applicature in corpus() + [random_applicature(rnd) for _ in range(samples)]:
+        s = _Song(applicature)
+        assert ug.get_chords(s) == legacy_get_chords(s), applicature
+
+
+def run(number: int = 2000) -> dict:
+    songs = [_Song(applicature) for applicature in corpus()]
+    ug.chord_shape.cache_clear()
+    results = {}
+    for name, fn in (("get_chords", ug.get_chords), ("legacy", legacy_get_chords)):
+        seconds = min(timeit.repeat(lambda: [fn(s) for s in songs], number=number, repeat=3))
+        results[f"{name}_us"] = round(seconds / number / len(songs) * 1e6, 2)
+    results["shape_cache"] = ug.chord_shape.cache_info()._asdict()
+    return results
+
+
+if __name__ == "__main__":
+    check_identical()
+    print("get_chords and the former implementation produce identical chords and fingerings")
+    for name, value in run().items():
+        print(f"{name:12} {value}")
@@ -0,0 +1,52 @@
+"""Compare the js-store extraction fast path with the BeautifulSoup parser.
+
+Run with: python -m benchmarks.bench_extract
+"""
+import json
+import timeit
+
+from bs4 import BeautifulSoup
+
+from freetar import ug
+from benchmarks.fixtures import search_pages, tab_pages
+
+
+def _song(page: str, extract) -> bytes:
+    s = ug.SongDetail(extract(page))
+    s.chords, s.fingers_for_strings = ug.get_chords(s)
+    return s.to_bytes()
+
+
+def _full_soup(page: str) -> dict:
+    """What ug_tab and Search did before the fast path"""
+    bs = BeautifulSoup(page, 'html.parser')
+    return json.loads(bs.find("div", {"class": "js-store"}).attrs['data-content'])
+
+
+def check_identical():
+    for page in tab_pages():
+        assert _song(page, ug._extract_store_fast) == _song(page, ug._extract_store_soup)
+    for page in search_pages():
+        fast = ug._extract_store_fast(page)
+        soup = ug._extract_store_soup(page)
+        assert fast == soup
+        search = ug.Search.__new__(ug.Search)
+        assert search.get_results(fast) == search.get_results(soup)
+
+
+def run(number: int = 3) -> dict:
+    results = {}
+    for kind, pages in (("tab", tab_pages()), ("search", search_pages())):
+        for name, extract in (("fast", ug._extract_store_fast),
+                              ("soup", ug._extract_store_soup),
+                              ("full_soup", _full_soup)):
+            seconds = min(timeit.repeat(lambda: [extract(p) for p in pages], number=number, repeat=3))
+            results[f"{kind}_{name}_ms"] = round(seconds / number / len(pages) * 1000, 3)
+    return results
+
+
+if __name__ == "__main__":
+    check_identical()
+    print("fast path and BeautifulSoup produce identical results")
+    for name, ms in run().items():
+        print(f"{name:24} {ms:10.3f} ms/page")
@@ -0,0 +1,69 @@
+"""Compare render_tab with the former chain of regex/replace passes in SongDetail.fix_tab.
+
+Run with: python -m benchmarks.bench_render
+"""
+import random
+import re
+import timeit
+
+from freetar import ug
+from benchmarks.fixtures import tab_data
+
+
+def _legacy_chord(chord):
+    root = '<span class="chord-root">%s</span>' % chord.group('root')
+    quality = ''
+    bass = ''
+    if chord.group('quality') is not None:
+        quality = '<span class="chord-quality">%s</span>' % chord.group('quality')
+    if chord.group('bass') is not None:
+        bass = '/<span class="chord-bass">%s</span>' % chord.group('bass')[1:]
+    return '<span class="chord fw-bold">%s</span>' % (root + quality + bass)
+
+
+def legacy_fix_tab(tab: str) -> str:
+    """SongDetail.fix_tab before render_tab"""
+    tab = re.sub(r"[a-zA-Z][\|\-\:].*\n?", "", tab, flags=re.MULTILINE)
+    tab = tab.replace("\r\n", "<br/>")
+    tab = tab.replace("\n", "<br/>")
+    tab = tab.replace(" ", "&nbsp;")
+    tab = tab.replace("[tab]", "")
+    tab = tab.replace("[/tab]", "")
+    tab = re.sub(r"<br/>(&nbsp;)*<br/>", "</div><div class='tab-block'>", tab)
+    tab = re.sub(r'\[ch\](?P<root>[A-Ha-h](#|b)?)(?P<quality>[^[/]+)?(?P<bass>/[A-Ha-h](#|b)?)?\[\/ch\]', _legacy_chord, tab)
+    return "<div class='tab-block'>" + tab + "</div>"
+
+
+def render(tab: str) -> str:
+    return "".join(ug.render_tab(tab))
+
+
+# fragments the random tabs are built from, chosen to hit the edge cases of the markup
+FRAGMENTS = ["[ch]", "[/ch]", "[tab]", "[/tab]", "Am", "C#", "Bb", "m7", "/G", "/F#", "maj7", "(add9)",
+             " ", "  ", "\n", "\r\n", "\r", "e|", "B-", "G:", "x", "-", "|", ":", "<br/>", "&nbsp;", "&",
+             "[", "]", "/", "h", "Verse", "[ch]Am[/ch]", "[ch]C/G[/ch]", "[ch]D sus[/ch]"]
+
+
+def check_identical(samples: int = 20000, seed: int = 0):
+    rnd = random.Random(seed)
+    tabs = [tab_data(verses=verses)["store"]["page"]["data"]["tab_view"]["wiki_tab"]["content"] for verses in (1, 40)]
+    tabs += ["".join(rnd.choice(FRAGMENTS) for _ in range(rnd.randint(0, 30))) for _ in range(samples)]
+    for tab in tabs:
+        assert render(tab) == legacy_fix_tab(tab), repr(tab)
+
+
+def run(number: int = 200) -> dict:
+    results = {}
+    for verses in (10, 40, 120):
+        tab = tab_data(verses=verses)["store"]["page"]["data"]["tab_view"]["wiki_tab"]["content"]
+        for name, fn in (("render_tab", render), ("legacy", legacy_fix_tab)):
+            seconds = min(timeit.repeat(lambda: fn(tab), number=number, repeat=3))
+            results[f"{len(tab) // 1024}kb_{name}_ms"] = round(seconds / number * 1000, 3)
+    return results
+
+
+if __name__ == "__main__":
+    check_identical()
+    print("render_tab and the former fix_tab produce identical output")
+    for name, ms in run().items():
+        print(f"{name:24} {ms:10.3f} ms/tab")
@@ -0,0 +1,91 @@
+"""UG pages for the benchmarks.
+
+Recorded pages (the HTML of a tab or search page, saved from ultimate-guitar.com)
+can be dropped into benchmarks/pages/ as ``tab-*.html`` and ``search-*.html``.
+Without recordings, synthetic pages with the same structure as UG's are used:
+a large document with the page data as HTML escaped JSON in ``div.js-store``.
+"""
+import glob
+import html
+import json
+import os
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), "pages")
+
+VERSE = ("[ch]Am[/ch]        [ch]C/G[/ch]          [ch]F#m7b5[/ch]\r\n"
+         "Some words of the song  and a few more\r\n"
+         "[ch]G[/ch]     [ch]Dsus4[/ch]   [ch]Cmaj7[/ch]\n"
+         "Another line that is sung here\n")
+
+APPLICATURE = {
+    "Am": [{"frets": [0, 1, 2, 2, 0, -1], "fingers": [0, 1, 3, 2, 0, 0]},
+           {"frets": [5, 5, 5, 7, 7, 5], "fingers": [1, 1, 1, 3, 4, 1]}],
+    "C/G": [{"frets": [0, 1, 0, 2, 3, 3], "fingers": [0, 1, 0, 2, 3, 4]}],
+    "F#m7b5": [{"frets": [-1, 1, 2, 2, -1, 2], "fingers": [0, 1, 3, 4, 0, 2]}],
+    "G": [{"frets": [3, 0, 0, 0, 2, 3], "fingers": [4, 0, 0, 0, 1, 2]},
+          {"frets": [3, 3, 4, 5, 5, 3], "fingers": [1, 1, 2, 3, 4, 1]}],
+    "Dsus4": [{"frets": [3, 3, 2, 0, -1, -1], "fingers": [3, 4, 1, 0, 0, 0]}],
+    "Cmaj7": [{"frets": [0, 0, 0, 2, 3, -1], "fingers": [0, 0, 0, 2, 3, 0]},
+              {"frets": [7, 8, 9, 9, 10, -1], "fingers": [1, 2, 3, 3, 4, 0]}],
+}
+
+
+def _result(artist: str, song: str, i: int, _type: str = "Chords") -> dict:
+    slug = f"{artist}/{song}".lower().replace(" ", "-")
+    return {"artist_name": artist,
+            "song_name": song,
+            "tab_url": f"https://tabs.ultimate-guitar.com/tab/{slug}-{_type.lower()}-{1000 + i}",
+            "artist_url": f"https://www.ultimate-guitar.com/artist/{artist.lower().replace(' ', '-')}",
+            "type": _type,
+            "version": i + 1,
+            "votes": 17 * i + 3,
+            "rating": 4.0 + (i % 10) / 10 + 0.04}
+
+
+def tab_data(artist: str = "Some Artist", song: str = "Some Song", verses: int = 40) -> dict:
+    content = "[Intro]\r\n"
+    for i in range(verses):
+        content += f"[Verse {i + 1}]\r\n" + VERSE + "\r\n"
+        if i % 4 == 0:
+            content += "[tab]e|---0---1---3---|\r\nB|---1---1---0---|\r\nG:---2---2---0---|\n[/tab]\n"
+        if i % 5 == 0:
+            content += "[tab][ch]G[/ch]    [ch]Am[/ch]\nWords  in a tab  block[/tab]\n\n  \n"
+    versions = [_result(artist, song, i) for i in range(8)] + [_result(artist, song, 9, "Official")]
+    tab = _result(artist, song, 0)
+    return {"store": {"page": {"data": {
+        "tab": {**tab, "rating": 4},
+        "tab_view": {"wiki_tab": {"content": content},
+                     "ug_difficulty": "intermediate",
+                     "applicature": APPLICATURE,
+                     "meta": {"capo": 2, "tuning": {"value": "E A D G B E", "name": "Standard"}},
+                     "versions": versions}}}}}
+
+
+def search_data(term: str = "some song", page: int = 1, total: int = 5) -> dict:
+    types = ["Chords", "Tabs", "Chords", "Pro", "Official", "Ukulele"]
+    results = [_result(f"Artist {i % 7}", f"{term} {i % 11}", i + 50 * page, types[i % len(types)]) for i in range(50)]
+    return {"store": {"page": {"data": {"results": results,
+                                        "pagination": {"total": total, "current": page}}}}}
+
+
+def page(data: dict) -> str:
+    """Wrap page data into a document the size and shape of an UG page"""
+    head = "<script>window.UGAPP = {};</script>\n" * 50 + "<link rel='stylesheet' href='/static/x.css'>\n" * 30
+    body = ("<div class='row'><a href='/tab/x'>link &amp; text</a><span data-x=\"1\">text</span></div>\n" * 1500)
+    return (f"<!DOCTYPE html><html><head>{head}</head><body>{body}"
+            f"<div class=\"js-store\" data-content=\"{html.escape(json.dumps(data))}\"></div>"
+            f"{body}</body></html>")
+
+
+def tab_pages() -> list:
+    recorded = sorted(glob.glob(os.path.join(PAGES_DIR, "tab-*.html")))
+    if recorded:
+        return [open(path, encoding="utf-8").read() for path in recorded]
+    return [page(tab_data(verses=verses)) for verses in (10, 40, 120)]
+
+
+def search_pages() -> list:
+    recorded = sorted(glob.glob(os.path.join(PAGES_DIR, "search-*.html")))
+    if recorded:
+        return [open(path, encoding="utf-8").read() for path in recorded]
+    return [page(search_data(page=i)) for i in (1, 2)]
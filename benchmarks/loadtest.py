@@ -0,0 +1,223 @@
+"""Load test simulating a live jam session against the real server stack.
+
+freetar's main() (waitress on 22001, websocket server on 22002) runs in a
+subprocess in a temporary directory, with UG replaced by
+benchmarks.stub_server. Browsing clients keep requesting tabs, /api/live
+and /favorites. Websocket clients listen for shares, and every share makes
+all of them open the shared tab at once, like a room full of phones.
+Shares are posted at a fixed rate.
+
+Reported: p50/p95/p99 latency per route, the delay from posting a share to
+its delivery over the websocket, requests that reached the UG stand-in and
+the RSS of the server.
+
+Run with: python -m benchmarks.loadtest --clients 20 --ws-clients 50 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from websockets import connect
+
+from benchmarks.stub_server import StubUG
+
+PORT = 22001
+WS_PORT = 22002
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentiles(times: list) -> dict:
+    if not times:
+        return {"count": 0}
+    times = sorted(times)
+
+    def pick(p):
+        return round(times[max(0, math.ceil(len(times) * p) - 1)] * 1000, 2)
+    return {"count": len(times), "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99),
+            "max_ms": round(times[-1] * 1000, 2)}
+
+
+def rss_kb(pid: int):
+    """Resident set size of a process, only available on Linux"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+class LoadTest:
+    def __init__(self, base: str, ws_url: str, songs: int):
+        self.base = base
+        self.ws_url = ws_url
+        self.songs = [f"/tab/artist-{i}/song-{i}-chords-{1000 + i}" for i in range(songs)]
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.shared_at = {}
+        self.delivery = []
+        self.stop = threading.Event()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def request(self, route: str, method: str, path: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self._session().request(method, self.base + path, timeout=30, **kwargs)
+            ok = response.status_code < 500
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            if ok:
+                self.latencies[route].append(elapsed)
+            else:
+                self.errors[route] += 1
+
+    def browse(self):
+        """One browsing client: mostly tabs, sometimes the live state and the favorites"""
+        rnd = random.Random()
+        while not self.stop.is_set():
+            action = rnd.random()
+            if action < 0.6:
+                self.request("GET /tab", "GET", rnd.choice(self.songs))
+            elif action < 0.8:
+                self.request("GET /api/live", "GET", "/api/live?latest=1")
+            elif action < 0.95:
+                self.request("GET /favorites", "GET", "/favorites")
+            else:
+                self.request("POST /favorites", "POST", "/favorites",
+                             json={"tab_url": rnd.choice(self.songs), "artist_name": "a", "song": "s"})
+            time.sleep(rnd.uniform(0.05, 0.3))
+
+    def share(self, rate: float):
+        """Post a new share `rate` times per minute"""
+        i = 0
+        while not self.stop.wait(60 / rate):
+            url = f"/tab/jam/song-{i}-chords-{5000 + i}"
+            i += 1
+            with self._lock:
+                self.shared_at[url] = time.perf_counter()
+            self.request("POST /api/live", "POST", "/api/live", json={"url": url})
+
+    async def listen(self, pool: ThreadPoolExecutor):
+        """One websocket client: open every shared tab as soon as it is announced"""
+        loop = asyncio.get_running_loop()
+        while not self.stop.is_set():
+            try:
+                async with connect(self.ws_url) as ws:
+                    while not self.stop.is_set():
+                        try:
+                            message = json.loads(await asyncio.wait_for(ws.recv(), 1))
+                        except asyncio.TimeoutError:
+                            continue
+                        if message.get("type") != "live":
+                            continue
+                        url = message["latest"]["url"]
+                        with self._lock:
+                            if url in self.shared_at:
+                                self.delivery.append(time.perf_counter() - self.shared_at[url])
+                        loop.run_in_executor(pool, self.request, "GET /tab (shared)", "GET", url)
+            except Exception as e:
+                with self._lock:
+                    self.errors["websocket"] += 1
+                print(f"Websocket client failed: {e}")
+                await asyncio.sleep(1)
+
+    def run_listeners(self, count: int):
+        async def run():
+            with ThreadPoolExecutor(max_workers=count) as pool:
+                await asyncio.gather(*(self.listen(pool) for _ in range(count)))
+        asyncio.run(run())
+
+
+def wait_for_server(base: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(base + "/about", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("freetar did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=20, help="browsing clients")
+    parser.add_argument("--ws-clients", type=int, default=50, help="websocket clients")
+    parser.add_argument("--share-rate", type=float, default=6, help="shares per minute")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--songs", type=int, default=200, help="distinct tabs the clients browse")
+    parser.add_argument("--threads", default=os.environ.get("THREADS", "4"), help="THREADS of the server")
+    parser.add_argument("--latency", type=float, default=0.1, help="latency of the UG stand-in, seconds")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    with StubUG(latency=args.latency) as stub:
+        env = {**os.environ,
+               "FREETAR_UG_URL": stub.url,
+               "THREADS": str(args.threads),
+               "PYTHONPATH": os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")]))}
+        server = subprocess.Popen([sys.executable, "-c", "from freetar.backend import main; main()"],
+                                  cwd=tempfile.mkdtemp(prefix="freetar-load-"), env=env,
+                                  stdout=subprocess.DEVNULL)
+        try:
+            base = f"http://127.0.0.1:{PORT}"
+            wait_for_server(base)
+            test = LoadTest(base, f"ws://127.0.0.1:{WS_PORT}", args.songs)
+            threads = [threading.Thread(target=test.browse, daemon=True) for _ in range(args.clients)]
+            threads.append(threading.Thread(target=test.share, args=(args.share_rate,), daemon=True))
+            threads.append(threading.Thread(target=test.run_listeners, args=(args.ws_clients,), daemon=True))
+            for thread in threads:
+                thread.start()
+
+            rss = []
+            deadline = time.monotonic() + args.duration
+            while time.monotonic() < deadline:
+                rss.append(rss_kb(server.pid))
+                time.sleep(1)
+            test.stop.set()
+            for thread in threads:
+                thread.join(timeout=35)
+            stats = requests.get(base + "/api/cache", timeout=5).json()
+        finally:
+            server.terminate()
+            server.wait()
+
+    rss = [kb for kb in rss if kb is not None]
+    results = {"config": vars(args),
+               "routes": {route: percentiles(times) for route, times in sorted(test.latencies.items())},
+               "errors": dict(test.errors),
+               "broadcast_delivery": percentiles(test.delivery),
+               "upstream": {"requests": stub.requests,
+                            "tab": stats["upstream"]["tab"],
+                            "search": stats["upstream"]["search"]},
+               "server": {"rss_max_kb": max(rss) if rss else None,
+                          "rss_last_kb": rss[-1] if rss else None,
+                          "websocket": stats.get("websocket")}}
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
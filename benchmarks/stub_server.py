@@ -0,0 +1,95 @@
+"""A local stand-in for ultimate-guitar.com, serving the pages of benchmarks.fixtures.
+
+freetar uses it when started with FREETAR_UG_URL set to its address:
+
+    python -m benchmarks.stub_server --port 22100
+    FREETAR_UG_URL=http://127.0.0.1:22100 freetar
+
+/search.php answers with a search page (chosen by the page parameter),
+/tab/<anything> with a tab page (chosen by a hash of the path). `latency`
+delays every answer, to imitate the round trip to UG.
+"""
+import argparse
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.fixtures import search_pages, tab_pages
+
+
+class StubUG:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0):
+        self.latency = latency
+        self.tab_pages = [p.encode() for p in tab_pages()]
+        self.search_pages = [p.encode() for p in search_pages()]
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def page(self, path: str) -> bytes:
+        url = urlparse(path)
+        if url.path == "/search.php":
+            page = int(parse_qs(url.query).get("page", ["1"])[0])
+            return self.search_pages[(page - 1) % len(self.search_pages)]
+        if url.path.startswith("/tab/"):
+            return self.tab_pages[zlib.crc32(url.path.encode()) % len(self.tab_pages)]
+        return None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                body = stub.page(self.path)
+                self.send_response(200 if body is not None else 404)
+                body = body or b"not found"
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "StubUG":
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stub-ug", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "StubUG":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=22100)
+    parser.add_argument("--latency", type=float, default=0, help="seconds to wait before answering")
+    args = parser.parse_args()
+    stub = StubUG(args.host, args.port, args.latency)
+    print(f"Serving UG stand-in on {stub.url}")
+    stub.server.serve_forever()
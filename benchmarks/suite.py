@@ -0,0 +1,136 @@
+"""Benchmark suite that runs without network access.
+
+Micro benchmarks time the single steps of serving a tab (extracting the
+js-store, SongDetail, fix_tab, get_chords, rendering the template),
+macro benchmarks cold and warm /tab and /search requests through the Flask
+test client, with UG replaced by benchmarks.stub_server. The app runs in a
+temporary directory, so its cache starts empty and ./data is left alone.
+
+Run with: python -m benchmarks.suite [--output results.json] [--compare old.json]
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import tempfile
+import time
+import timeit
+from datetime import datetime, timezone
+
+from benchmarks.fixtures import search_pages, tab_pages
+from benchmarks.stub_server import StubUG
+
+
+def _ms(fn, number: int) -> float:
+    """Best time of one call, in ms"""
+    return round(min(timeit.repeat(fn, number=number, repeat=3)) / number * 1000, 3)
+
+
+def micro(number: int) -> dict:
+    from flask import render_template
+    from freetar import ug
+    from freetar.backend import app, encode_page
+
+    page = tab_pages()[len(tab_pages()) // 2]
+    search_page = search_pages()[0]
+    data = ug.extract_store(page)
+    search_data = ug.extract_store(search_page)
+    content = data["store"]["page"]["data"]["tab_view"]["wiki_tab"]["content"]
+    song = ug.SongDetail(data)
+    song.chords, song.fingers_for_strings = ug.get_chords(song)
+    search = ug.Search.__new__(ug.Search)
+
+    results = {
+        "extract_soup_ms": _ms(lambda: ug._extract_store_soup(page), max(1, number // 20)),
+        "extract_fast_ms": _ms(lambda: ug.extract_store(page), number),
+        "song_detail_ms": _ms(lambda: ug.SongDetail(data), number),
+        "fix_tab_ms": _ms(lambda: "".join(ug.render_tab(content)), number),
+        "get_chords_ms": _ms(lambda: ug.get_chords(song), number),
+        "search_results_ms": _ms(lambda: search.get_results(search_data), number),
+    }
+    with app.test_request_context("/tab/some-artist/some-song"):
+        rendered = render_template("tab.html", tab=song, title=str(song))
+        results["render_tab_template_ms"] = _ms(lambda: render_template("tab.html", tab=song, title=str(song)),
+                                                number)
+        results["encode_page_ms"] = _ms(lambda: encode_page(rendered), max(1, number // 10))
+    return results
+
+
+def _requests(client, urls, headers=None) -> dict:
+    times = []
+    for url in urls:
+        start = time.perf_counter()
+        response = client.get(url, headers=headers or {})
+        times.append(time.perf_counter() - start)
+        assert response.status_code == 200, (url, response.status_code)
+    times.sort()
+    return {"mean_ms": round(statistics.mean(times) * 1000, 3),
+            "p95_ms": round(times[math.ceil(len(times) * 0.95) - 1] * 1000, 3)}
+
+
+def macro(stub: StubUG, requests: int) -> dict:
+    from freetar.backend import app
+
+    client = app.test_client()
+    tabs = [f"/tab/artist-{i}/song-{i}-chords-{1000 + i}" for i in range(requests)]
+    searches = [f"/search?search_term=song+{i}" for i in range(requests)]
+    results = {}
+    for name, urls in (("tab", tabs), ("search", searches)):
+        before = stub.requests
+        results[f"{name}_cold"] = _requests(client, urls)
+        results[f"{name}_warm"] = _requests(client, urls)
+        results[f"{name}_warm_gzip"] = _requests(client, urls, {"Accept-Encoding": "gzip"})
+        results[f"{name}_upstream_requests"] = stub.requests - before
+    return results
+
+
+def compare(old: dict, new: dict, prefix: str = ""):
+    for key, value in new.items():
+        if isinstance(value, dict):
+            compare(old.get(key, {}), value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and isinstance(old.get(key), (int, float)) and old[key]:
+            print(f"{prefix + key:40} {old[key]:10.3f} {value:10.3f} {value / old[key]:8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--number", type=int, default=200, help="calls per micro benchmark")
+    parser.add_argument("--requests", type=int, default=50, help="requests per macro benchmark")
+    parser.add_argument("--latency", type=float, default=0, help="latency of the UG stand-in, seconds")
+    args = parser.parse_args()
+    # the app runs in a temporary directory
+    output = os.path.abspath(args.output) if args.output else None
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    with StubUG(latency=args.latency) as stub:
+        # freetar reads its configuration at import time
+        os.environ["FREETAR_UG_URL"] = stub.url
+        # pacing requests protects UG, not the stand-in, and would hide the cost of a cold request
+        os.environ.setdefault("FREETAR_UPSTREAM_RATE", "0")
+        os.chdir(tempfile.mkdtemp(prefix="freetar-bench-"))
+        from freetar.utils import get_version
+
+        results = {"freetar": get_version(),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                   "micro": micro(args.number),
+                   "macro": macro(stub, args.requests)}
+
+    print(json.dumps(results, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    if previous:
+        with open(previous) as f:
+            old = json.load(f)
+        print(f"\n{'':40} {'before':>10} {'after':>10} {'ratio':>8}")
+        compare(old, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+# largest request body accepted (favorites, shares, ...)
+MAX_BODY = 1024 * 1024
+
+
+class ASGIWebSocket:
+    """The part of a websockets connection WebSocketManager uses, on top of an ASGI websocket"""
+
+    def __init__(self, receive, send):
+        self._receive = receive
+        self._send = send
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.closed:
+            message = await self._receive()
+            if message["type"] == "websocket.receive":
+                return message.get("text") or message.get("bytes")
+            if message["type"] == "websocket.disconnect":
+                self.closed = True
+        raise StopAsyncIteration
+
+    async def send(self, message: str):
+        if self.closed:
+            raise ConnectionError("websocket is closed")
+        await self._send({"type": "websocket.send", "text": message})
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        if not self.closed:
+            self.closed = True
+            await self._send({"type": "websocket.close", "code": code, "reason": reason})
+
+
+class AsyncServer:
+    """ASGI application serving the Flask app and the websocket on one port, from one event loop
+
+    Flask views are blocking, so they run in thread pools, but a request only
+    gets a thread once it can make progress. Requests that would have to wait
+    for UG (`needs_upstream`) run in a second pool, as large as the pool of
+    upstream sessions; everything else, above all cached pages, in the first
+    one, so a few slow fetches can't hold up the rest of the site. Requests
+    waiting for a pool, or for the same page someone else is fetching, are
+    coroutines, not threads. Websockets at `ws_path` are handed to `ws_manager`.
+    """
+
+    def __init__(self,
+                 wsgi_app,
+                 ws_manager,
+                 needs_upstream: Callable[[dict], bool],
+                 threads: int = 4,
+                 upstream_threads: int = 4,
+                 ws_path: str = "/ws"):
+        self.wsgi_app = wsgi_app
+        self.ws_manager = ws_manager
+        self.needs_upstream = needs_upstream
+        self.ws_path = ws_path
+        self.threads = threads
+        self.upstream_threads = upstream_threads
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="freetar-app")
+        self._upstream_pool = ThreadPoolExecutor(max_workers=upstream_threads, thread_name_prefix="freetar-upstream")
+        # pages being fetched from UG, by path and query string
+        self._fetching = {}
+        self.requests = 0
+        self.in_flight = 0
+        self.upstream_requests = 0
+        self.upstream_in_flight = 0
+        self.coalesced = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self.http(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await self.websocket(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # broadcasts from Flask views are handed to this loop
+                self.ws_manager.loop = asyncio.get_running_loop()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._pool.shutdown(wait=False)
+                self._upstream_pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def websocket(self, scope, receive, send):
+        if scope["path"] != self.ws_path:
+            # closing before accepting answers the handshake with a 403
+            await send({"type": "websocket.close", "code": 1008})
+            return
+        if (await receive())["type"] != "websocket.connect":
+            return
+        await send({"type": "websocket.accept"})
+        await self.ws_manager.register(ASGIWebSocket(receive, send))
+
+    async def http(self, scope, receive, send):
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if len(body) > MAX_BODY:
+                await self._respond(send, "413 Request Entity Too Large", [], b"")
+                return
+
+        self.requests += 1
+        self.in_flight += 1
+        try:
+            status, headers, content = await self._dispatch(scope, body)
+        finally:
+            self.in_flight -= 1
+        await self._respond(send, status, headers, content)
+
+    async def _dispatch(self, scope, body: bytes):
+        loop = asyncio.get_running_loop()
+        key = (scope["path"], scope["query_string"])
+        waited = False
+        while True:
+            fetching = self._fetching.get(key)
+            if fetching is not None and not waited:
+                # someone is fetching this page, it's probably cached once they are done
+                self.coalesced += 1
+                waited = True
+                await asyncio.wait([fetching])
+            response = await loop.run_in_executor(self._pool, self._call, self._environ(scope, body), True)
+            if response is not None:
+                return response
+            # a fetch may have started while we checked the cache
+            if waited or key not in self._fetching:
+                break
+
+        self.upstream_requests += 1
+        self.upstream_in_flight += 1
+        future = loop.run_in_executor(self._upstream_pool, self._call, self._environ(scope, body), False)
+        self._fetching.setdefault(key, future)
+        try:
+            return await future
+        finally:
+            self.upstream_in_flight -= 1
+            if self._fetching.get(key) is future:
+                del self._fetching[key]
+
+    def _call(self, environ: dict, check: bool):
+        """Run the Flask app, or return None if `check` is set and the request would wait for UG"""
+        if check and self.needs_upstream(environ):
+            return None
+        response = []
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return chunks.append
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                chunks.append(chunk)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        status, headers = response
+        return status, headers, b"".join(chunks)
+
+    def _environ(self, scope, body: bytes) -> dict:
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+            # WSGI wants the path as latin-1 decoded bytes
+            "PATH_INFO": scope["path"].encode().decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+                continue
+            if name == "CONTENT_LENGTH":
+                continue
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    @staticmethod
+    async def _respond(send, status: str, headers, content: bytes):
+        await send({"type": "http.response.start",
+                    "status": int(status.split(" ", 1)[0]),
+                    "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+        await send({"type": "http.response.body", "body": content})
+
+    def stats(self) -> dict:
+        return {"mode": "async",
+                "threads": self.threads,
+                "upstream_threads": self.upstream_threads,
+                "requests": self.requests,
+                "in_flight": self.in_flight,
+                "upstream_requests": self.upstream_requests,
+                "upstream_in_flight": self.upstream_in_flight,
+                "coalesced": self.coalesced}
+
+
+def serve(server: AsyncServer, host: str, port: int, ws_max_size: Optional[int] = 64 * 1024):
+    """Run an AsyncServer with uvicorn (pip install freetar[async])"""
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit('FREETAR_SERVER=async needs uvicorn: pip install "freetar[async]"')
+    uvicorn.run(server, host=host, port=port, lifespan="on", ws_max_size=ws_max_size,
+                access_log=False, log_level="warning")
@@ -0,0 +1,58 @@
+import mimetypes
+import os
+from typing import Dict, Optional, Tuple
+
+from freetar.encoding import EncodedBody
+
+
+class AssetBundle:
+    """Static files, minified and compressed once, served under content-hashed names.
+
+    `build()` reads every asset, minifies scripts and stylesheets with the
+    app's minifier and keeps the result in memory, e.g. custom.js becomes
+    custom.<hash>.js. As the name changes whenever the content changes,
+    browsers may cache these files forever. Templates get the URLs from
+    `url(name)`, files that are not part of the bundle stay under /static.
+    """
+
+    MINIFY = {".js": "script", ".css": "style"}
+
+    def __init__(self, folder: str, names, parser, prefix: str = "/assets/"):
+        self.folder = folder
+        self.names = names
+        self.parser = parser
+        self.prefix = prefix
+        self._urls: Dict[str, str] = {}
+        self._files: Dict[str, Tuple[EncodedBody, str]] = {}
+
+    def build(self):
+        urls, files = {}, {}
+        for name in self.names:
+            stem, ext = os.path.splitext(name)
+            with open(os.path.join(self.folder, name), "rb") as f:
+                content = f.read()
+            if ext in self.MINIFY:
+                content = self.parser.minify(content.decode(), self.MINIFY[ext]).encode()
+            body = EncodedBody(content, compress=ext in self.MINIFY)
+            hashed = f"{stem}.{body.etag[:12]}{ext}"
+            mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            urls[name] = self.prefix + hashed
+            files[hashed] = (body, mimetype)
+        self._urls, self._files = urls, files
+        print(f"Built {len(files)} static assets")
+
+    def url(self, name: str) -> str:
+        return self._urls.get(name, f"/static/{name}")
+
+    def current_url(self, hashed: str) -> Optional[str]:
+        """URL of the current version of an asset given by an outdated hashed name
+
+        Pages cached before the assets changed still refer to the old names.
+        """
+        stem, _, rest = hashed.partition(".")
+        _, _, ext = rest.rpartition(".")
+        url = self._urls.get(f"{stem}.{ext}")
+        return url if url != self.prefix + hashed else None
+
+    def get(self, hashed: str) -> Optional[Tuple[EncodedBody, str]]:
+        return self._files.get(hashed)
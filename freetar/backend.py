@@ -1,99 +1,435 @@
+import time
+# how long importing freetar takes is shown on /api/cache
+IMPORT_STARTED = time.perf_counter()
+import atexit
 import waitress
 import os
 import json
-from flask import Flask, render_template, request, jsonify
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, g, redirect, render_template, request, jsonify
 from flask_caching import Cache
 from flask_minify import Minify
 import asyncio
 import threading
 import socket
+import sqlite3
+from functools import wraps
+from urllib.parse import urlencode
 from websockets import serve
 
-from freetar.ug import Search, ug_tab
+from freetar.asgi import AsyncServer, serve as serve_async
+from freetar.assets import AssetBundle
+from freetar.cache import CacheStats
+from freetar.encoding import EncodedBody
+from freetar.index import SearchIndex
+from freetar import metrics, snapshot
+from freetar.prefetch import Prefetcher
+from freetar.state import from_env as state_from_env
+from freetar.ug import Search, SearchResult, SongDetail, aggregate_search, breaker, scraper, scheduler, search_flight, stage_histogram, tab_flight, ug_search, ug_tab
 from freetar.utils import get_version, FreetarError
 from freetar.websocket import ws_manager
 
-cache = Cache(config={'CACHE_TYPE': 'SimpleCache',
-                      "CACHE_DEFAULT_TIMEOUT": 0,
+# Data file paths — stored in ./data relative to working directory
+DATA_DIR = os.path.join(".", "data")
+os.makedirs(DATA_DIR, exist_ok=True)
+FAVORITES_FILE = os.path.join(DATA_DIR, "freetar_favorites.json")
+RECENT_SHARES_FILE = os.path.join(DATA_DIR, "freetar_recent_shares.json")
+CACHE_FILE = os.path.join(DATA_DIR, "freetar_cache.sqlite3")
+INDEX_FILE = os.path.join(DATA_DIR, "freetar_index.sqlite3")
+
+# FREETAR_CACHE=simple keeps the old in-memory cache (lost on restart, private to one process),
+# FREETAR_CACHE=memory an in-memory cache limited to FREETAR_CACHE_MAX_MB, split between routes
+if os.environ.get("FREETAR_CACHE", "sqlite") == "simple":
+    cache_config = {'CACHE_TYPE': 'SimpleCache'}
+elif os.environ.get("FREETAR_CACHE") == "memory":
+    cache_config = {'CACHE_TYPE': 'freetar.cache.MemoryCache',
+                    'CACHE_MAX_BYTES': int(os.environ.get("FREETAR_CACHE_MAX_MB", "64")) * 1024 * 1024,
+                    'CACHE_QUOTAS': os.environ.get("FREETAR_CACHE_QUOTAS", "tab=60,search=30,other=10")}
+else:
+    cache_config = {'CACHE_TYPE': 'freetar.cache.SQLiteCache',
+                    'CACHE_SQLITE_PATH': CACHE_FILE,
+                    'CACHE_MAX_BYTES': int(os.environ.get("FREETAR_CACHE_MAX_MB", "256")) * 1024 * 1024}
+
+cache = Cache(config={**cache_config,
+                      "CACHE_DEFAULT_TIMEOUT": int(os.environ.get("FREETAR_CACHE_TIMEOUT", "0")),
                       "CACHE_THRESHOLD": 10000})
 
 app = Flask(__name__)
 cache.init_app(app)
-Minify(app=app, html=True, js=True, cssless=True)
+# the cache backend, for its stats
+cache_backend = app.extensions["cache"][cache]
+
+# With FREETAR_CACHE=memory, the hottest cache entries are written to a snapshot on shutdown
+# and put back into the cache on startup. 0: no snapshot
+SNAPSHOT_FILE = os.path.join(DATA_DIR, "freetar_snapshot.bin")
+SNAPSHOT_BYTES = int(os.environ.get("FREETAR_SNAPSHOT_MB", "16")) * 1024 * 1024
+startup = {}
+
+
+def load_snapshot():
+    start = time.perf_counter()
+    entries = snapshot.load(SNAPSHOT_FILE)
+    startup["snapshot_entries"] = cache_backend.restore(entries)
+    startup["snapshot_seconds"] = round(time.perf_counter() - start, 3)
+    if entries:
+        print(f"Loaded {startup['snapshot_entries']} cache entries from {SNAPSHOT_FILE}")
+
+
+def save_snapshot():
+    count, size = snapshot.save(SNAPSHOT_FILE, cache_backend.hottest(SNAPSHOT_BYTES))
+    print(f"Saved {count} cache entries ({size // 1024} KB) to {SNAPSHOT_FILE}")
+
+
+if SNAPSHOT_BYTES and hasattr(cache_backend, "hottest"):
+    load_snapshot()
+    atexit.register(save_snapshot)
+
+
+class PageMinify(Minify):
+    """Minify responses, except for cached pages, which were minified once when they were rendered"""
+
+    def main(self, response):
+        if g.get("minified"):
+            return response
+        return super().main(response)
+
+
+minify = PageMinify(app=app, html=True, js=True, cssless=True)
+
+# custom.js, styles.css and the icon are served minified and compressed under content-hashed URLs
+assets = AssetBundle(app.static_folder, ("custom.js", "styles.css", "guitar.png"), minify.parser)
+assets.build()
 
 # Global variable to track WebSocket server
 _websocket_server = None
 _websocket_thread = None
+# HTTP and websocket server on one port, with FREETAR_SERVER=async
+SERVER_MODE = os.environ.get("FREETAR_SERVER", "waitress")
+async_server = None
 
 # Global variable to store the last shared song
 last_shared_song = None
 
-# Global variable to store recent shares (list of recent songs)
-recent_shares = []
+# Recent shares (list of recent songs)
 MAX_RECENT_SHARES = 100
 
-# Global variable to store shared favorites
-shared_favorites = {}
+# Favorites and recent shares of this process (snapshot + journal, ring buffer),
+# or with FREETAR_STATE=sqlite shared by all freetar processes
+state = state_from_env(DATA_DIR, FAVORITES_FILE, RECENT_SHARES_FILE, MAX_RECENT_SHARES)
+shared_favorites = state.favorites
+recent_shares = state.recent_shares
+
+# Load favorites and recent shares on startup
+state.load()
+
+# shares received by other processes go to the websocket clients of this one, and vice versa
+state.subscribe(ws_manager.publish)
+ws_manager.relay = state.publish
+
+# Hit/miss stats of the parsed song cache and of the rendered page cache
+data_cache_stats = CacheStats()
+render_cache_stats = CacheStats()
+DATA_LOOKUP_SECONDS = metrics.registry.histogram("freetar_cache_lookup_seconds", "Duration of cache lookups",
+                                                 cache="data")
+PAGE_LOOKUP_SECONDS = metrics.registry.histogram("freetar_cache_lookup_seconds", "Duration of cache lookups",
+                                                 cache="page")
+RENDER_SECONDS = stage_histogram("render")
+
+# Cached pages older than this (seconds) are still served, but refreshed in the background. 0: never refresh
+CACHE_MAX_AGE = int(os.environ.get("FREETAR_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+refresher = ThreadPoolExecutor(max_workers=int(os.environ.get("FREETAR_REFRESH_THREADS", "2")),
+                               thread_name_prefix="freetar-refresh")
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+# Number of search results/alternative versions to prefetch into the cache. 0: no prefetching
+PREFETCH = int(os.environ.get("FREETAR_PREFETCH", "0"))
+
+
+def warm_tab(url_path: str) -> bool:
+    """Put a song into the data cache, unless it's there already or UG is busy/failing"""
+    with app.app_context(), scheduler.priority(scheduler.BACKGROUND):
+        key = f"tabdata/{url_path}"
+        if cache.has(key) or breaker.state != "closed" or not scraper.has_capacity():
+            return False
+        tab = ug_tab(url_path)
+        cache.set(key, tab.to_bytes())
+        index_tab(tab)
+        return True
+
+
+# Where /search looks: upstream (UG, the local index only if UG fails), local (the local
+# index first, UG to fill up short results) or offline (only the local index)
+SEARCH_MODE = os.environ.get("FREETAR_SEARCH", "upstream")
+# in local mode, a search with at least this many local results doesn't ask UG
+SEARCH_LOCAL_MIN = int(os.environ.get("FREETAR_SEARCH_LOCAL_MIN", "10"))
+SEARCH_PAGE_SIZE = 50
+# with more than 1, the first FREETAR_SEARCH_PAGES result pages of UG are fetched at once, merged
+# and ranked, and cached as one result set that page navigation is served from
+SEARCH_PAGES = int(os.environ.get("FREETAR_SEARCH_PAGES", "1"))
+
+# songs from search results, tabs and favorites, for searching without UG
+search_index = SearchIndex(INDEX_FILE)
+search_stats = {"local": 0, "upstream": 0, "fallback": 0, "aggregated": 0, "aggregated_pages": 0}
+
+
+def index_songs(results):
+    try:
+        search_index.add(results)
+    except sqlite3.Error as e:
+        print(f"Could not index songs: {e}")
 
-# Data file paths — stored in ./data relative to working directory
-DATA_DIR = os.path.join(".", "data")
-os.makedirs(DATA_DIR, exist_ok=True)
-FAVORITES_FILE = os.path.join(DATA_DIR, "freetar_favorites.json")
-RECENT_SHARES_FILE = os.path.join(DATA_DIR, "freetar_recent_shares.json")
 
-def load_favorites():
-    """Load favorites from JSON file"""
-    global shared_favorites
+def index_favorites(favorites):
     try:
-        if os.path.exists(FAVORITES_FILE):
-            with open(FAVORITES_FILE, 'r') as f:
-                shared_favorites = json.load(f)
-                print(f"Loaded {len(shared_favorites)} favorites from {FAVORITES_FILE}")
-        else:
-            shared_favorites = {}
-            print(f"No favorites file found, starting with empty favorites")
-    except Exception as e:
-        print(f"Error loading favorites: {e}")
-        shared_favorites = {}
+        search_index.add_favorites(favorites)
+    except sqlite3.Error as e:
+        print(f"Could not index favorites: {e}")
 
-def save_favorites():
-    """Save favorites to JSON file"""
-    try:
-        with open(FAVORITES_FILE, 'w') as f:
-            json.dump(shared_favorites, f, indent=2)
-        print(f"Saved {len(shared_favorites)} favorites to {FAVORITES_FILE}")
-    except Exception as e:
-        print(f"Error saving favorites: {e}")
 
-def load_recent_shares():
-    """Load recent shares from JSON file"""
-    global recent_shares
+index_favorites(shared_favorites.as_dict().values())
+
+
+def index_tab(tab: SongDetail):
+    index_songs([tab.to_search_result(), *tab.alternatives])
+
+
+def local_search(search_term: str, page: int) -> Search:
+    results, total = search_index.search(search_term, SEARCH_PAGE_SIZE, (page - 1) * SEARCH_PAGE_SIZE)
+    return Search.from_results(results, -(-total // SEARCH_PAGE_SIZE), page)
+
+
+def search_key(search_term: str) -> str:
+    """Key of the merged results of an aggregated search in the data cache"""
+    return f"searchdata/{' '.join(search_term.lower().split())}"
+
+
+def aggregated_search(search_term: str, page: int) -> Search:
+    """A page of the merged results of the first SEARCH_PAGES pages of UG, fetched once per term"""
+    key = search_key(search_term)
+    records = None
+    # a background refresh needs fresh data from UG
+    if not g.get("refresh"):
+        with DATA_LOOKUP_SECONDS.time():
+            records = cache.get(key)
+    if records is None:
+        results, pages = aggregate_search(search_term, SEARCH_PAGES)
+        search_stats["aggregated"] += 1
+        search_stats["aggregated_pages"] += pages
+        records = [result.to_record() for result in results]
+        cache.set(key, records)
+        index_songs(results)
+    start = (page - 1) * SEARCH_PAGE_SIZE
+    results = [SearchResult.from_record(record) for record in records[start:start + SEARCH_PAGE_SIZE]]
+    return Search.from_results(results, -(-len(records) // SEARCH_PAGE_SIZE), page)
+
+
+def find(search_term: str, page: int) -> Search:
+    """Search UG and/or the local index, depending on SEARCH_MODE"""
+    local = None
+    if SEARCH_MODE != "upstream":
+        local = local_search(search_term, page)
+        if SEARCH_MODE == "offline" or len(local.results) >= SEARCH_LOCAL_MIN:
+            search_stats["local"] += 1
+            return local
     try:
-        if os.path.exists(RECENT_SHARES_FILE):
-            with open(RECENT_SHARES_FILE, 'r') as f:
-                recent_shares = json.load(f)
-                print(f"Loaded {len(recent_shares)} recent shares from {RECENT_SHARES_FILE}")
+        if SEARCH_PAGES > 1:
+            upstream = aggregated_search(search_term, page)
         else:
-            recent_shares = []
-            print(f"No recent shares file found, starting with empty list")
-    except Exception as e:
-        print(f"Error loading recent shares: {e}")
-        recent_shares = []
-
-def save_recent_shares():
-    """Save recent shares to JSON file"""
+            upstream = ug_search(search_term, page)
+    except FreetarError:
+        # UG failed or blocks us, answer from what we know
+        local = local or local_search(search_term, page)
+        if not local.results:
+            raise
+        search_stats["fallback"] += 1
+        return local
+    search_stats["upstream"] += 1
+    if SEARCH_PAGES <= 1:
+        index_songs(upstream.results)
+    if not local or not local.results:
+        return upstream
+    seen = {result.tab_url for result in local.results}
+    return Search.from_results(local.results + [r for r in upstream.results if r.tab_url not in seen],
+                               max(local.total_pages, upstream.total_pages), page)
+
+
+prefetcher = Prefetcher(warm_tab, budget=int(os.environ.get("FREETAR_PREFETCH_BUDGET", "30")))
+
+
+def prefetch(results):
+    """Prefetch the tabs of the first PREFETCH search results or alternatives"""
+    if PREFETCH:
+        paths = [r.tab_url[len("/tab/"):] for r in results[:PREFETCH] if r.tab_url.startswith("/tab/")]
+        prefetcher.submit(paths)
+
+
+def get_tab(url_path: str) -> SongDetail:
+    """Get a parsed song, either from the data cache or from UG"""
+    key = f"tabdata/{url_path}"
+    # a background refresh needs fresh data from UG
+    record = None
+    if not g.get("refresh"):
+        with DATA_LOOKUP_SECONDS.time():
+            record = cache.get(key)
+    if record is not None:
+        try:
+            tab = SongDetail.from_bytes(record)
+            data_cache_stats.hit()
+            prefetcher.used(str(url_path))
+            return tab
+        except (ValueError, EOFError, TypeError) as e:
+            print(f"Dropping unreadable cache record {key}: {e}")
+    data_cache_stats.miss()
+    tab = ug_tab(url_path)
+    cache.set(key, tab.to_bytes())
+    index_tab(tab)
+    return tab
+
+
+@metrics.timed(stage_histogram("encode"))
+def encode_page(page: str) -> EncodedBody:
+    """Minify and compress a rendered page for the page cache"""
+    return EncodedBody(minify.parser.minify(page, "html").encode())
+
+
+def encoded_response(body: EncodedBody, mimetype: str = "text/html"):
+    """Serve a cached page or asset in the encoding the client accepts, or a 304"""
+    g.minified = True
+    encoding, data, etag = body.select(request.accept_encodings)
+    response = app.response_class(data, mimetype=mimetype)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def refresh_page(key: str, path: str, query_string: str, view, args, kwargs):
+    """Render a page again with fresh data from UG and replace the cached copy.
+
+    If that fails (UG blocks us, ...), the stale copy stays in the cache.
+    """
     try:
-        with open(RECENT_SHARES_FILE, 'w') as f:
-            json.dump(recent_shares, f, indent=2)
-        print(f"Saved {len(recent_shares)} recent shares to {RECENT_SHARES_FILE}")
+        with app.test_request_context(path, query_string=query_string), scheduler.priority(scheduler.BACKGROUND):
+            g.refresh = True
+            page = encode_page(view(*args, **kwargs))
+            cache.set(key, (page, time.time()))
     except Exception as e:
-        print(f"Error saving recent shares: {e}")
-
-# Load favorites from disk on startup
-load_favorites()
+        print(f"Could not refresh {path}: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def schedule_refresh(key: str, view, args, kwargs):
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    refresher.submit(refresh_page, key, request.path, request.query_string.decode(), view, args, kwargs)
+
+
+def page_key(req) -> str:
+    """Key of a page in the page cache, by path and query string
+
+    Tab pages don't read the query string, it's left out of their key.
+    """
+    if req.path.startswith("/tab/"):
+        return f"view/{req.path}"
+    return f"view/{req.path}?{urlencode(sorted(req.args.items(multi=True)))}"
+
+
+def needs_upstream(environ: dict) -> bool:
+    """Whether a request may have to wait for UG: a tab or search page that isn't cached"""
+    req = app.request_class(environ)
+    if req.method != "GET":
+        return False
+    if req.path.startswith("/tab/"):
+        data_key = f"tabdata/{req.path[len('/tab/'):]}"
+    elif req.path == "/search" and req.args.get("search_term") and SEARCH_MODE != "offline":
+        data_key = search_key(req.args["search_term"]) if SEARCH_PAGES > 1 else None
+    else:
+        return False
+    with app.app_context():
+        if cache.has(page_key(req)):
+            return False
+        return data_key is None or not cache.has(data_key)
+
+
+def cached_page(view):
+    """Cache the rendered page of a view, keyed by path and query string
+
+    Pages are stored minified and compressed, so a cache hit is served
+    without any rendering or compression work. Pages older than CACHE_MAX_AGE
+    are served as they are (marked with a Warning header) and refreshed in the
+    background.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = page_key(request)
+        with PAGE_LOOKUP_SECONDS.time():
+            entry = cache.get(key)
+        if entry is not None:
+            render_cache_stats.hit()
+            page, stored_at = entry if isinstance(entry, tuple) else (entry, 0)
+            if not isinstance(page, EncodedBody):
+                # cached before pages were stored encoded, encode it once
+                page = encode_page(page)
+                cache.set(key, (page, stored_at))
+            response = encoded_response(page)
+            if CACHE_MAX_AGE and time.time() - stored_at > CACHE_MAX_AGE:
+                schedule_refresh(key, view, args, kwargs)
+                response.headers["Warning"] = '110 - "Response is Stale"'
+            return response
+        render_cache_stats.miss()
+        page = encode_page(view(*args, **kwargs))
+        cache.set(key, (page, time.time()))
+        return encoded_response(page)
+    return wrapper
+
+
+def render(template: str, **context) -> str:
+    """render_template, timed"""
+    with RENDER_SECONDS.time():
+        return render_template(template, **context)
+
+
+@metrics.registry.collector
+def collect_stats():
+    """Export the stats shown on /api/cache as metrics"""
+    for name, stats in (("data", data_cache_stats), ("page", render_cache_stats)):
+        yield "freetar_cache_hits_total", "counter", "Cache hits", {"cache": name}, stats.hits
+        yield "freetar_cache_misses_total", "counter", "Cache misses", {"cache": name}, stats.misses
+    for name, flight in (("tab", tab_flight), ("search", search_flight)):
+        flight_stats = flight.stats()
+        yield ("freetar_upstream_calls_total", "counter", "Fetches from Ultimate Guitar",
+               {"kind": name}, flight_stats["upstream_calls"])
+        yield ("freetar_coalesced_calls_total", "counter", "Requests that waited for a running fetch",
+               {"kind": name}, flight_stats["coalesced_calls"])
+    if hasattr(cache_backend, "stats"):
+        for route, route_stats in cache_backend.stats()["routes"].items():
+            yield "freetar_cache_bytes", "gauge", "Bytes stored in the cache", {"route": route}, route_stats["bytes"]
+            yield ("freetar_cache_evictions_total", "counter", "Entries evicted from the cache",
+                   {"route": route}, route_stats["evictions"])
+    scheduler_stats = scheduler.stats()
+    yield "freetar_upstream_queue_depth", "gauge", "Requests waiting for their turn to ask UG", {}, \
+        scheduler_stats["queue_depth"]
+    for name in scheduler.PRIORITIES.values():
+        yield ("freetar_upstream_dropped_total", "counter", "Requests to UG dropped after their deadline",
+               {"priority": name}, scheduler_stats[name]["dropped"])
+    yield "freetar_breaker_open", "gauge", "Whether requests to Ultimate Guitar are paused", {}, \
+        int(breaker.state != "closed")
+    prefetch_stats = prefetcher.stats()
+    yield "freetar_prefetch_fetched_total", "counter", "Prefetched tabs", {}, prefetch_stats["fetched"]
+    yield "freetar_prefetch_hits_total", "counter", "Prefetched tabs requested later", {}, prefetch_stats["hits"]
+    yield "freetar_import_seconds", "gauge", "Time it took to import freetar", {}, startup.get("import_seconds", 0)
+    yield "freetar_favorites", "gauge", "Shared favorites", {}, len(shared_favorites)
+    yield "freetar_recent_shares", "gauge", "Recent shares", {}, len(recent_shares)
 
-# Load recent shares from disk on startup
-load_recent_shares()
 
 def is_port_in_use(port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -103,6 +439,8 @@ def is_port_in_use(port):
 def export_variables():
     return {
         'version': get_version(),
+        'asset_url': assets.url,
+        'server_mode': SERVER_MODE,
     }
 
 
@@ -112,7 +450,7 @@ def index():
 
 
 @app.route("/search")
-@cache.cached(query_string=True)
+@cached_page
 def search():
     search_term = request.args.get("search_term")
     try:
@@ -122,29 +460,32 @@ def search():
                                error="Invalid page requested. Not a number.")
     search_results = None
     if search_term:
-        search_results = Search(search_term, page)
-    return render_template("index.html",
-                           search_term=search_term,
-                           title=f"Freetar - Search: {search_term}",
-                           search_results=search_results)
+        search_results = find(search_term, page)
+        prefetch(search_results.results)
+    return render("index.html",
+                  search_term=search_term,
+                  title=f"Freetar - Search: {search_term}",
+                  search_results=search_results)
 
 
 @app.route("/tab/<artist>/<song>")
-@cache.cached()
+@cached_page
 def show_tab(artist: str, song: str):
-    tab = ug_tab(f"{artist}/{song}")
-    return render_template("tab.html",
-                           tab=tab,
-                           title=f"{tab.artist_name} - {tab.song_name}")
+    tab = get_tab(f"{artist}/{song}")
+    prefetch(tab.alternatives)
+    return render("tab.html",
+                  tab=tab,
+                  title=f"{tab.artist_name} - {tab.song_name}")
 
 
 @app.route("/tab/<tabid>")
-@cache.cached()
+@cached_page
 def show_tab2(tabid: int):
-    tab = ug_tab(tabid)
-    return render_template("tab.html",
-                           tab=tab,
-                           title=f"{tab.artist_name} - {tab.song_name}")
+    tab = get_tab(tabid)
+    prefetch(tab.alternatives)
+    return render("tab.html",
+                  tab=tab,
+                  title=f"{tab.artist_name} - {tab.song_name}")
 
 
 @app.route("/favs")
@@ -157,69 +498,55 @@ def show_favs():
 @app.route("/live")
 def show_live():
     """Show the live session page with recent shares"""
-    global recent_shares
-    
-    # Check if there's been activity in the past 20 minutes
-    live_session_active = False
-    filtered_shares = []
-    
-    if recent_shares:
-        from datetime import datetime, timedelta
-        current_time = datetime.now()
-        twenty_minutes_ago = current_time - timedelta(minutes=20)
-        
-        try:
-            most_recent = recent_shares[0]
-            most_recent_time = datetime.fromisoformat(most_recent["timestamp"])
-            
-            if most_recent_time >= twenty_minutes_ago:
-                live_session_active = True
-                
-            # Filter shares to only show those from the past 20 minutes
-            for share in recent_shares:
-                share_time = datetime.fromisoformat(share["timestamp"])
-                if share_time >= twenty_minutes_ago:
-                    filtered_shares.append(share)
-                    
-        except Exception as e:
-            print(f"Error checking live session activity: {e}")
-    
+    # Only show shares from the past 20 minutes, the session is active if there are any
+    filtered_shares = recent_shares.shares_since(time.time() - 20 * 60)
     return render_template("live.html",
                            title="Freetar - Live Session",
-                           live_session_active=live_session_active,
+                           live_session_active=bool(filtered_shares),
                            recent_shares=filtered_shares)
 
 
+# Only show the banner if the most recent share is within 5 minutes
+LIVE_BANNER_SECONDS = 5 * 60
+_live_bodies = {}
+
+
+def live_state(share: dict, version: int) -> dict:
+    """The message pushed to all websocket clients when something was shared"""
+    return {"type": "live", "version": version, "latest": share, "show_banner": True}
+
+
 @app.route("/api/live", methods=["GET"])
 def get_live():
-    """Get the recent shared songs"""
-    global recent_shares
-    if recent_shares:
-        from datetime import datetime, timedelta
-        
-        # Check if the most recent share is within 5 minutes
-        try:
-            most_recent = recent_shares[0]
-            share_time = datetime.fromisoformat(most_recent["timestamp"])
-            current_time = datetime.now()
-            time_diff = current_time - share_time
-            
-            # Only show banner if most recent share is within 5 minutes
-            if time_diff <= timedelta(minutes=5):
-                return jsonify({"shares": recent_shares, "show_banner": True})
-            else:
-                return jsonify({"shares": recent_shares, "show_banner": False})
-        except Exception as e:
-            print(f"Error checking timestamp: {e}")
-            return jsonify({"shares": recent_shares, "show_banner": False})
-    else:
+    """Get the recent shared songs, or only the latest one with ?latest=1
+
+    Responses carry an ETag, so clients can revalidate them with a 304.
+    """
+    version, share, shared_at = recent_shares.latest_version()
+    if share is None:
         return jsonify({"shares": []}), 404
+    latest_only = request.args.get("latest") == "1"
+    show_banner = time.time() - shared_at <= LIVE_BANNER_SECONDS
+    etag = f"live-{recent_shares.epoch}-{version}-{int(show_banner)}-{int(latest_only)}"
+    body = _live_bodies.get(etag)
+    if body is None:
+        if latest_only:
+            data = {"latest": share, "show_banner": show_banner, "version": version}
+        else:
+            data = {"shares": recent_shares.shares(), "show_banner": show_banner, "version": version}
+        body = json.dumps(data)
+        if len(_live_bodies) > 8:
+            _live_bodies.clear()
+        _live_bodies[etag] = body
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
 
 
 @app.route("/api/live", methods=["POST"])
 def set_live():
     """Add a song to recent shares"""
-    global recent_shares
     data = request.get_json()
     if data and "url" in data:
         from datetime import datetime
@@ -240,23 +567,18 @@ def set_live():
                 except Exception as e:
                     print(f"Error parsing URL {url}: {e}")
         
-        # Remove if already exists to avoid duplicates
-        recent_shares = [share for share in recent_shares if share["url"] != url]
-        
-        # Add new share at the beginning with current timestamp and names
-        new_share = {
+        # Add new share with current timestamp and names, replacing an older share of the same URL
+        share = {
             "url": url,
             "artist_name": artist_name,
             "song_name": song_name,
             "timestamp": datetime.now().isoformat()
         }
-        recent_shares.insert(0, new_share)
-        
-        # Keep only the most recent shares
-        recent_shares = recent_shares[:MAX_RECENT_SHARES]
-        
-        # Save to disk
-        save_recent_shares()
+        version = recent_shares.add(share)
+        # push the new live state to all clients instead of having them poll /api/live
+        message = live_state(share, version)
+        ws_manager.publish(message)
+        state.publish(message)
         
         return jsonify({"status": "success"})
     return jsonify({"status": "error"}), 400
@@ -265,14 +587,12 @@ def set_live():
 @app.route("/favorites", methods=["GET"])
 def get_favorites():
     """Get all shared favorites"""
-    global shared_favorites
-    return jsonify(shared_favorites)
+    return app.response_class(shared_favorites.serialized(), mimetype="application/json")
 
 
 @app.route("/favorites", methods=["POST"])
 def add_favorite():
     """Add a song to shared favorites"""
-    global shared_favorites
     data = request.get_json()
     if data and "tab_url" in data:
         fav = {
@@ -282,8 +602,8 @@ def add_favorite():
             "rating": data.get("rating", ""),
             "tab_url": data["tab_url"]
         }
-        shared_favorites[data["tab_url"]] = fav
-        save_favorites()  # Save to disk
+        shared_favorites.add(data["tab_url"], fav)
+        index_favorites([fav])
         return jsonify({"status": "success"})
     return jsonify({"status": "error"}), 400
 
@@ -291,15 +611,51 @@ def add_favorite():
 @app.route("/favorites", methods=["DELETE"])
 def remove_favorite():
     """Remove a song from shared favorites"""
-    global shared_favorites
     data = request.get_json()
-    if data and "tab_url" in data and data["tab_url"] in shared_favorites:
-        del shared_favorites[data["tab_url"]]
-        save_favorites()  # Save to disk
+    if data and "tab_url" in data and shared_favorites.remove(data["tab_url"]):
         return jsonify({"status": "success"})
     return jsonify({"status": "error"}), 400
 
 
+@app.route("/api/cache", methods=["GET"])
+def get_cache_stats():
+    """Get hit/miss stats of the song data cache and the page cache, upstream, prefetch and websocket stats"""
+    return jsonify({"data": data_cache_stats.as_dict(),
+                    "render": render_cache_stats.as_dict(),
+                    "store": cache_backend.stats() if hasattr(cache_backend, "stats") else None,
+                    "upstream": {"tab": tab_flight.stats(),
+                                 "search": search_flight.stats(),
+                                 "pool": scraper.stats(),
+                                 "breaker": breaker.stats(),
+                                 "scheduler": scheduler.stats()},
+                    "prefetch": prefetcher.stats(),
+                    "websocket": ws_manager.stats(),
+                    "server": async_server.stats() if async_server else {"mode": "waitress"},
+                    "startup": startup,
+                    "search": {"mode": SEARCH_MODE, "indexed_songs": len(search_index), **search_stats}})
+
+
+@app.route("/assets/<filename>")
+def show_asset(filename: str):
+    """A static asset with a content-hashed name, which browsers never need to check again"""
+    asset = assets.get(filename)
+    if asset is None:
+        current = assets.current_url(filename)
+        return redirect(current) if current else ("", 404)
+    body, mimetype = asset
+    response = encoded_response(body, mimetype)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Latency histograms and counters in the Prometheus text format"""
+    if not metrics.ENABLED:
+        return "", 404
+    return app.response_class(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/about")
 def show_about():
     return render_template('about.html')
@@ -317,6 +673,7 @@ def internal_error(error):
 
 async def websocket_server(host: str, port: int):
     try:
+        ws_manager.loop = asyncio.get_running_loop()
         async with serve(ws_manager.register, host, port):
             print(f"WebSocket server successfully started on ws://{host}:{port}")
             await asyncio.Future()  # run forever
@@ -340,10 +697,17 @@ def start_websocket_server(host: str, port: int):
         _websocket_thread.daemon = True
         _websocket_thread.start()
 
+startup["import_seconds"] = round(time.perf_counter() - IMPORT_STARTED, 3)
+print(f"freetar loaded in {startup['import_seconds'] * 1000:.0f} ms")
+
+
 def main():
+    global async_server
     host = "0.0.0.0"
-    port = 22001
-    ws_port = 22002
+    # several freetar processes on one host need their own ports
+    # (FREETAR_PORT is the port docker-compose publishes, not the one freetar listens on)
+    port = int(os.environ.get("FREETAR_LISTEN_PORT", "22001"))
+    ws_port = int(os.environ.get("FREETAR_LISTEN_WS_PORT", str(port + 1)))
     
     if __name__ == '__main__':
         # Only start WebSocket server in main process (not in Flask reloader)
@@ -353,6 +717,16 @@ def main():
         app.run(debug=True,
                 host=host,
                 port=port)
+        return
+
+    # docker stop sends SIGTERM: exit cleanly, so favorites, shares and the cache snapshot are saved
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if SERVER_MODE == "async":
+        # HTTP and websockets (under /ws) on one port, served from one event loop
+        threads = int(os.environ.get("THREADS", "4"))
+        async_server = AsyncServer(app, ws_manager, needs_upstream, threads=threads, upstream_threads=scraper.size)
+        print(f"Running backend on {host}:{port} (async, {threads} + {scraper.size} upstream threads)")
+        serve_async(async_server, host, port)
     else:
         # Production mode
         start_websocket_server(host, ws_port)
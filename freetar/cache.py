@@ -0,0 +1,409 @@
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from flask_caching.backends.base import BaseCache
+
+
+class SQLiteCache(BaseCache):
+    """Persistent cache backend stored in a single SQLite database.
+
+    The database runs in WAL mode, so any number of readers (waitress threads
+    or separate freetar processes) can use it while one of them writes. Every
+    thread gets its own connection. Entries expire after their timeout and the
+    least recently used ones are evicted once either ``threshold`` entries or
+    ``max_bytes`` of payload are exceeded. As everything lives on disk, a
+    restarted instance starts with all of its previously cached pages.
+    """
+
+    # prune at most every n-th write, pruning scans the whole table
+    PRUNE_INTERVAL = 50
+    # seconds the recorded last access of an entry may lag behind, LRU eviction doesn't need more
+    ACCESS_RESOLUTION = 60
+
+    def __init__(self,
+                 path: str,
+                 threshold: int = 10000,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 default_timeout: int = 300,
+                 ignore_delete_many_errors: bool = False):
+        super().__init__(default_timeout=default_timeout,
+                         ignore_delete_many_errors=ignore_delete_many_errors)
+        self.path = path
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                key TEXT PRIMARY KEY,
+                                value BLOB NOT NULL,
+                                expires REAL NOT NULL,
+                                accessed REAL NOT NULL,
+                                size INTEGER NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    @classmethod
+    def factory(cls, app, config: dict[str, Any], args: list[Any], kwargs: dict[str, Any]):
+        kwargs.update(dict(path=config["CACHE_SQLITE_PATH"],
+                           threshold=config["CACHE_THRESHOLD"]))
+        if config.get("CACHE_MAX_BYTES"):
+            kwargs["max_bytes"] = config["CACHE_MAX_BYTES"]
+        return cls(*args, **kwargs)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _expires(self, timeout: Optional[int]) -> float:
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout > 0 else 0
+
+    def _maybe_prune(self):
+        with self._writes_lock:
+            self._writes += 1
+            if self._writes % self.PRUNE_INTERVAL:
+                return
+        self._prune()
+
+    def _prune(self):
+        conn = self._connection()
+        conn.execute("DELETE FROM cache WHERE expires != 0 AND expires <= ?", (time.time(),))
+        count, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        if count <= self.threshold and size <= self.max_bytes:
+            return
+        # evict the least recently used entries until both limits hold again
+        excess_count = max(0, count - self.threshold)
+        excess_size = max(0, size - self.max_bytes)
+        evict = []
+        for key, entry_size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            if len(evict) >= excess_count and excess_size <= 0:
+                break
+            evict.append((key,))
+            excess_size -= entry_size
+        conn.executemany("DELETE FROM cache WHERE key = ?", evict)
+
+    def get(self, key: str) -> Any:
+        conn = self._connection()
+        row = conn.execute("SELECT value, expires, accessed FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires, accessed = row
+        now = time.time()
+        if expires and expires <= now:
+            return None
+        # a hit is a read, only now and then a write that competes for the WAL writer lock
+        if now - accessed > self.ACCESS_RESOLUTION:
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        try:
+            return pickle.loads(value)
+        except (pickle.PickleError, EOFError, AttributeError, ImportError):
+            return None
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        dump = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._connection().execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                                   (key, dump, self._expires(timeout), time.time(), len(dump)))
+        self._maybe_prune()
+        return True
+
+    def add(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        dump = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        conn = self._connection()
+        # an expired row must not block the add
+        conn.execute("DELETE FROM cache WHERE key = ? AND expires != 0 AND expires <= ?",
+                     (key, time.time()))
+        cursor = conn.execute("INSERT OR IGNORE INTO cache VALUES (?, ?, ?, ?, ?)",
+                              (key, dump, self._expires(timeout), time.time(), len(dump)))
+        if cursor.rowcount:
+            self._maybe_prune()
+        return cursor.rowcount == 1
+
+    def delete(self, key: str) -> bool:
+        cursor = self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+        return cursor.rowcount == 1
+
+    def has(self, key: str) -> bool:
+        row = self._connection().execute("SELECT expires FROM cache WHERE key = ?", (key,)).fetchone()
+        return row is not None and (not row[0] or row[0] > time.time())
+
+    def clear(self) -> bool:
+        self._connection().execute("DELETE FROM cache")
+        return True
+
+
+class SegmentedLRU:
+    """Byte-limited segmented LRU.
+
+    New entries start in the probation segment and move to the protected
+    segment (at most `protected_ratio` of the budget) when they are used
+    again. Evictions take the least recently used probation entry first, so a
+    burst of pages requested once can't push out the pages people come back to.
+    Entries are (payload, size, ...) tuples. Not thread-safe.
+    """
+
+    def __init__(self, max_bytes: int, protected_ratio: float = 0.8):
+        self.max_bytes = max_bytes
+        self.protected_max = int(max_bytes * protected_ratio)
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.bytes = 0
+        self.protected_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        entry = self.protected.get(key)
+        if entry is not None:
+            self.protected.move_to_end(key)
+            return entry
+        entry = self.probation.pop(key, None)
+        if entry is None:
+            return None
+        self.protected[key] = entry
+        self.protected_bytes += entry[1]
+        self._demote()
+        return entry
+
+    def _demote(self):
+        """Move the least recently used protected entries back to probation until the segment fits"""
+        while self.protected_bytes > self.protected_max:
+            demoted_key, demoted = self.protected.popitem(last=False)
+            self.protected_bytes -= demoted[1]
+            self.probation[demoted_key] = demoted
+
+    def peek(self, key: str):
+        return self.protected.get(key) or self.probation.get(key)
+
+    def put(self, key: str, entry: tuple) -> bool:
+        """Add or replace an entry. A replaced entry keeps its segment, a refreshed hot page stays protected"""
+        protected = key in self.protected
+        self.pop(key)
+        if entry[1] > self.max_bytes:
+            return False
+        if protected:
+            self.protected[key] = entry
+            self.protected_bytes += entry[1]
+            self._demote()
+        else:
+            self.probation[key] = entry
+        self.bytes += entry[1]
+        while self.bytes > self.max_bytes:
+            segment = self.probation if self.probation else self.protected
+            _, evicted = segment.popitem(last=False)
+            self.bytes -= evicted[1]
+            if segment is self.protected:
+                self.protected_bytes -= evicted[1]
+            self.evictions += 1
+        return True
+
+    def pop(self, key: str):
+        entry = self.probation.pop(key, None)
+        if entry is None:
+            entry = self.protected.pop(key, None)
+            if entry is None:
+                return None
+            self.protected_bytes -= entry[1]
+        self.bytes -= entry[1]
+        return entry
+
+    def clear(self):
+        self.probation.clear()
+        self.protected.clear()
+        self.bytes = 0
+        self.protected_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.probation) + len(self.protected)
+
+
+class MemoryCache(BaseCache):
+    """In-memory cache backend limited by the bytes it stores, not by the number of entries.
+
+    Values are pickled and zlib compressed, the size of an entry is its
+    compressed payload plus its key. Every route (tab pages and song data,
+    search pages and results, everything else) gets its own share of
+    ``max_bytes`` and its own segmented LRU, so a flood of searches can't
+    evict popular tabs. stats() reports the usage of every route.
+    """
+
+    ROUTES = ("tab", "search", "other")
+    # payloads smaller than this aren't worth compressing
+    COMPRESS_MIN = 256
+
+    def __init__(self,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 quotas: Optional[Dict[str, float]] = None,
+                 default_timeout: int = 300,
+                 ignore_delete_many_errors: bool = False):
+        super().__init__(default_timeout=default_timeout,
+                         ignore_delete_many_errors=ignore_delete_many_errors)
+        quotas = quotas or {"tab": 60, "search": 30, "other": 10}
+        total = sum(quotas.get(route, 0) for route in self.ROUTES) or 1
+        self.max_bytes = max_bytes
+        self.segments = {route: SegmentedLRU(int(max_bytes * quotas.get(route, 0) / total))
+                         for route in self.ROUTES}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, app, config: dict[str, Any], args: list[Any], kwargs: dict[str, Any]):
+        if config.get("CACHE_MAX_BYTES"):
+            kwargs["max_bytes"] = config["CACHE_MAX_BYTES"]
+        if config.get("CACHE_QUOTAS"):
+            kwargs["quotas"] = cls.parse_quotas(config["CACHE_QUOTAS"])
+        return cls(*args, **kwargs)
+
+    @staticmethod
+    def parse_quotas(spec: str) -> Dict[str, float]:
+        """"tab=60,search=30,other=10" -> shares of the budget per route"""
+        quotas = {}
+        for part in spec.split(","):
+            route, _, share = part.partition("=")
+            quotas[route.strip()] = float(share)
+        return quotas
+
+    @staticmethod
+    def route(key: str) -> str:
+        if key.startswith(("tabdata/", "view//tab/")):
+            return "tab"
+        if key.startswith(("searchdata/", "view//search")):
+            return "search"
+        return "other"
+
+    def _entry(self, key: str, value: Any, timeout: Optional[int]) -> tuple:
+        dump = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        compressed = len(dump) >= self.COMPRESS_MIN
+        if compressed:
+            dump = zlib.compress(dump, 6)
+        timeout = self._normalize_timeout(timeout)
+        expires = time.time() + timeout if timeout > 0 else 0
+        return dump, len(dump) + len(key), compressed, expires
+
+    @staticmethod
+    def _expired(entry: tuple) -> bool:
+        return bool(entry[3]) and entry[3] <= time.time()
+
+    def get(self, key: str) -> Any:
+        segment = self.segments[self.route(key)]
+        with self._lock:
+            entry = segment.get(key)
+            if entry is not None and self._expired(entry):
+                segment.pop(key)
+                entry = None
+            if entry is None:
+                segment.misses += 1
+                return None
+            segment.hits += 1
+        dump, _, compressed, _ = entry
+        try:
+            return pickle.loads(zlib.decompress(dump) if compressed else dump)
+        except (pickle.PickleError, zlib.error, EOFError, AttributeError, ImportError):
+            return None
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        entry = self._entry(key, value, timeout)
+        with self._lock:
+            return self.segments[self.route(key)].put(key, entry)
+
+    def add(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        entry = self._entry(key, value, timeout)
+        segment = self.segments[self.route(key)]
+        with self._lock:
+            existing = segment.peek(key)
+            if existing is not None and not self._expired(existing):
+                return False
+            return segment.put(key, entry)
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            return self.segments[self.route(key)].pop(key) is not None
+
+    def has(self, key: str) -> bool:
+        with self._lock:
+            entry = self.segments[self.route(key)].peek(key)
+        return entry is not None and not self._expired(entry)
+
+    def clear(self) -> bool:
+        with self._lock:
+            for segment in self.segments.values():
+                segment.clear()
+        return True
+
+    def hottest(self, max_bytes: int) -> list:
+        """Entries for a snapshot, most recently used first: (key, payload, compressed, expires)
+
+        Every route gets its share of `max_bytes`, protected entries go first.
+        """
+        entries = []
+        with self._lock:
+            for segment in self.segments.values():
+                budget = max_bytes * segment.max_bytes // (self.max_bytes or 1)
+                for ordered in (segment.protected, segment.probation):
+                    for key in reversed(ordered):
+                        dump, size, compressed, expires = ordered[key]
+                        budget -= size
+                        if budget < 0:
+                            break
+                        entries.append((key, dump, compressed, expires))
+                    if budget < 0:
+                        break
+        return entries
+
+    def restore(self, entries: list) -> int:
+        """Put the entries of a snapshot (as returned by hottest) back, returns how many fit"""
+        restored = 0
+        with self._lock:
+            # the hottest entries go in last, so they are the most recently used
+            for key, dump, compressed, expires in reversed(entries):
+                restored += self.segments[self.route(key)].put(key, (dump, len(dump) + len(key), compressed, expires))
+        return restored
+
+    def stats(self) -> dict:
+        with self._lock:
+            routes = {}
+            for route, segment in self.segments.items():
+                lookups = segment.hits + segment.misses
+                routes[route] = {"bytes": segment.bytes,
+                                 "quota_bytes": segment.max_bytes,
+                                 "entries": len(segment),
+                                 "evictions": segment.evictions,
+                                 "hits": segment.hits,
+                                 "misses": segment.misses,
+                                 "hit_ratio": round(segment.hits / lookups, 3) if lookups else None}
+        return {"max_bytes": self.max_bytes,
+                "bytes": sum(route["bytes"] for route in routes.values()),
+                "routes": routes}
+
+
+class CacheStats:
+    """Thread-safe hit/miss counters for one cache layer"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def as_dict(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else None}
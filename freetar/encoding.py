@@ -0,0 +1,46 @@
+import gzip
+import hashlib
+from typing import Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, without it only gzip is offered
+    brotli = None
+
+
+class EncodedBody:
+    """A response body together with its compressed variants and a strong ETag.
+
+    Compression happens once when the body is created. Serving it is only a
+    matter of picking the variant the client accepts. Already compressed
+    content (images) is kept with `compress=False`.
+    """
+
+    __slots__ = ("identity", "gzip", "br", "etag")
+
+    def __init__(self, body: bytes, compress: bool = True):
+        self.identity = body
+        self.gzip = gzip.compress(body, compresslevel=9, mtime=0) if compress else None
+        self.br = brotli.compress(body) if compress and brotli is not None else None
+        self.etag = hashlib.sha1(body).hexdigest()
+
+    def __getstate__(self):
+        return (self.identity, self.gzip, self.br, self.etag)
+
+    def __setstate__(self, state):
+        self.identity, self.gzip, self.br, self.etag = state
+
+    def __len__(self) -> int:
+        return len(self.identity)
+
+    def select(self, accept_encodings) -> Tuple[Optional[str], bytes, str]:
+        """(content encoding, body, ETag) of the best variant for an Accept-Encoding header
+
+        `accept_encodings` is werkzeug's parsed header, `request.accept_encodings`.
+        Every variant has its own ETag, as they are different representations.
+        """
+        if self.br is not None and accept_encodings.quality("br") > 0:
+            return "br", self.br, self.etag + "-br"
+        if self.gzip is not None and accept_encodings.quality("gzip") > 0:
+            return "gzip", self.gzip, self.etag + "-gz"
+        return None, self.identity, self.etag
@@ -0,0 +1,116 @@
+import re
+from typing import Iterable, List, Tuple
+
+from freetar.store import SQLiteStore
+from freetar.ug import SearchResult
+
+WORD_RE = re.compile(r"\w+")
+
+
+class SearchIndex(SQLiteStore):
+    """Full-text index (SQLite FTS5) of the songs freetar has seen
+
+    Search results, tabs with their alternative versions and favorites are
+    added as they pass through, so common searches can be answered without
+    asking UG. Every tab URL is one row, seen again it gets the newer
+    metadata. Matches are ranked by rating, weighted by the number of votes.
+    """
+
+    # votes at which a rating counts half
+    VOTES_WEIGHT = 10
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS songs (
+                                id INTEGER PRIMARY KEY,
+                                tab_url TEXT UNIQUE NOT NULL,
+                                artist_name TEXT NOT NULL,
+                                song_name TEXT NOT NULL,
+                                artist_url TEXT NOT NULL,
+                                type TEXT NOT NULL,
+                                version INTEGER NOT NULL,
+                                votes INTEGER NOT NULL,
+                                rating REAL NOT NULL)""")
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(
+                                artist_name, song_name, content='songs', content_rowid='id',
+                                tokenize='unicode61 remove_diacritics 2')""")
+            # keep the full-text index in sync with the songs table
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS songs_ai AFTER INSERT ON songs BEGIN
+                                INSERT INTO songs_fts (rowid, artist_name, song_name)
+                                VALUES (new.id, new.artist_name, new.song_name);
+                            END""")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS songs_au AFTER UPDATE ON songs BEGIN
+                                INSERT INTO songs_fts (songs_fts, rowid, artist_name, song_name)
+                                VALUES ('delete', old.id, old.artist_name, old.song_name);
+                                INSERT INTO songs_fts (rowid, artist_name, song_name)
+                                VALUES (new.id, new.artist_name, new.song_name);
+                            END""")
+
+    def add(self, results: Iterable[SearchResult]):
+        rows = [(r.tab_url, r.artist_name, r.song_name, r.artist_url or "", r._type or "",
+                 int(r.version or 0), int(r.votes or 0), float(r.rating or 0)) for r in results]
+        if not rows:
+            return
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN")
+            # a tab seen without votes (e.g. a favorite) keeps what a search result told us
+            conn.executemany("""INSERT INTO songs (tab_url, artist_name, song_name, artist_url, type,
+                                                   version, votes, rating)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                ON CONFLICT (tab_url) DO UPDATE SET
+                                    artist_name = excluded.artist_name,
+                                    song_name = excluded.song_name,
+                                    artist_url = CASE WHEN excluded.artist_url != ''
+                                                      THEN excluded.artist_url ELSE artist_url END,
+                                    type = CASE WHEN excluded.type != '' THEN excluded.type ELSE type END,
+                                    version = CASE WHEN excluded.version THEN excluded.version ELSE version END,
+                                    votes = MAX(votes, excluded.votes),
+                                    rating = CASE WHEN excluded.votes >= votes THEN excluded.rating ELSE rating END
+                                WHERE excluded.artist_name != artist_name OR excluded.song_name != song_name
+                                   OR excluded.votes > votes OR excluded.artist_url != artist_url
+                                   OR (excluded.votes >= votes AND excluded.rating != rating)""", rows)
+
+    def add_favorites(self, favorites: Iterable[dict]):
+        """Add favorites as stored by the favorites store"""
+        results = []
+        for favorite in favorites:
+            result = SearchResult.__new__(SearchResult)
+            result.artist_name = favorite.get("artist_name") or ""
+            result.song_name = favorite.get("song") or ""
+            result.tab_url = favorite["tab_url"]
+            result.artist_url = ""
+            result._type = favorite.get("type") or ""
+            result.version = 0
+            result.votes = 0
+            try:
+                result.rating = float(favorite.get("rating") or 0)
+            except ValueError:
+                result.rating = 0.0
+            results.append(result)
+        self.add(results)
+
+    @staticmethod
+    def _match(query: str) -> str:
+        # every word has to match, as a prefix
+        return " ".join(f'"{word}"*' for word in WORD_RE.findall(query.lower()))
+
+    def search(self, query: str, limit: int = 50, offset: int = 0) -> Tuple[List[SearchResult], int]:
+        """The matching songs, best first, and the total number of matches"""
+        match = self._match(query)
+        if not match:
+            return [], 0
+        conn = self._connection()
+        total = conn.execute("SELECT COUNT(*) FROM songs_fts WHERE songs_fts MATCH ?", (match,)).fetchone()[0]
+        rows = conn.execute("""SELECT s.artist_name, s.song_name, s.tab_url, s.artist_url, s.type,
+                                      s.version, s.votes, s.rating
+                               FROM songs_fts JOIN songs s ON s.id = songs_fts.rowid
+                               WHERE songs_fts MATCH ?
+                               ORDER BY s.rating * s.votes / (s.votes + ?) DESC, s.votes DESC, s.rating DESC
+                               LIMIT ? OFFSET ?""",
+                            (match, float(self.VOTES_WEIGHT), limit, offset)).fetchall()
+        return [SearchResult.from_record(row) for row in rows], total
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM songs").fetchone()[0]
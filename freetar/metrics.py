@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import Callable, Dict, List, Tuple
+
+# FREETAR_METRICS=0 turns all timers into no-ops and disables /metrics
+ENABLED = os.environ.get("FREETAR_METRICS", "1") != "0"
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_disabled = nullcontext()
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Histogram:
+    """Latency histogram of one metric/label combination"""
+
+    def __init__(self, name: str, labels: Dict[str, str], buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += seconds
+
+    @contextmanager
+    def _timer(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def time(self):
+        """Context manager that observes the time spent in its block"""
+        return self._timer() if ENABLED else _disabled
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{_labels({**self.labels, 'le': le})} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labels)} {total}")
+        lines.append(f"{self.name}_count{_labels(self.labels)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, labels: Dict[str, str]):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labels)} {self.value}"]
+
+
+class Registry:
+    """All metrics of the process, rendered in the Prometheus text format
+
+    Metrics are created once at import time with their labels. Values that
+    are already counted elsewhere (cache stats, websocket clients, ...) are
+    read by collectors when /metrics is requested.
+    """
+
+    def __init__(self):
+        self._families: Dict[str, Tuple[str, str, list]] = {}
+        self._collectors: List[Callable] = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, kind: str, name: str, help: str, labels: Dict[str, str]):
+        with self._lock:
+            _, _, metrics = self._families.setdefault(name, (kind, help, []))
+            for metric in metrics:
+                if metric.labels == labels:
+                    return metric
+            metric = cls(name, labels)
+            metrics.append(metric)
+            return metric
+
+    def histogram(self, name: str, help: str, **labels) -> Histogram:
+        return self._get(Histogram, "histogram", name, help, labels)
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        return self._get(Counter, "counter", name, help, labels)
+
+    def collector(self, collect: Callable):
+        """Register a function returning [(name, type, help, labels, value), ...]"""
+        self._collectors.append(collect)
+        return collect
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            families = list(self._families.items())
+        for name, (kind, help, metrics) in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metric in metrics:
+                lines.extend(metric.samples())
+        collected = {}
+        for collect in self._collectors:
+            try:
+                for name, kind, help, labels, value in collect():
+                    collected.setdefault(name, (kind, help, []))[2].append((labels, value))
+            except Exception as e:
+                print(f"Error collecting metrics: {e}")
+        for name, (kind, help, samples) in collected.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels)} {0 if value is None else value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def timed(histogram: Histogram):
+    """Decorator observing the run time of a function, a no-op if metrics are disabled"""
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -0,0 +1,94 @@
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class Prefetcher:
+    """Warm the cache with tabs users are likely to open next.
+
+    Paths are queued (bounded, the rest is dropped) and fetched one at a time
+    by a single background thread, at most `budget` per minute. `warm(path)`
+    does the actual work and returns False if there was nothing to do (already
+    cached, upstream busy or failing). Every path that was fetched and later
+    requested by a user counts as a hit. A budget of 0 disables prefetching.
+    """
+
+    def __init__(self, warm, budget: int = 30, queue_size: int = 100, remember: int = 1000):
+        self.warm = warm
+        self.budget = budget
+        self.remember = remember
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._queued = set()
+        self._prefetched = OrderedDict()
+        self._fetch_times = deque()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.dropped = 0
+        self.fetched = 0
+        self.skipped = 0
+        self.failed = 0
+        self.hits = 0
+
+    def submit(self, paths):
+        if self.budget <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="freetar-prefetch", daemon=True)
+                self._thread.start()
+            for path in paths:
+                if path in self._queued or path in self._prefetched:
+                    continue
+                try:
+                    self._queue.put_nowait(path)
+                    self._queued.add(path)
+                except queue.Full:
+                    self.dropped += 1
+
+    def used(self, path):
+        """A user requested `path`"""
+        with self._lock:
+            if self._prefetched.pop(path, None) is not None:
+                self.hits += 1
+
+    def _wait_for_budget(self):
+        while True:
+            now = time.monotonic()
+            while self._fetch_times and now - self._fetch_times[0] > 60:
+                self._fetch_times.popleft()
+            if len(self._fetch_times) < self.budget:
+                self._fetch_times.append(now)
+                return
+            time.sleep(60 - (now - self._fetch_times[0]))
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            self._wait_for_budget()
+            try:
+                fetched = self.warm(path)
+            except Exception as e:
+                print(f"Prefetching {path} failed: {e}")
+                fetched = None
+            with self._lock:
+                self._queued.discard(path)
+                if fetched is None:
+                    self.failed += 1
+                elif not fetched:
+                    self.skipped += 1
+                    self._fetch_times.pop()
+                else:
+                    self.fetched += 1
+                    self._prefetched[path] = True
+                    if len(self._prefetched) > self.remember:
+                        self._prefetched.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(),
+                "dropped": self.dropped,
+                "fetched": self.fetched,
+                "skipped": self.skipped,
+                "failed": self.failed,
+                "hits": self.hits,
+                "hit_ratio": round(self.hits / self.fetched, 3) if self.fetched else None}
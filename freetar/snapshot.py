@@ -0,0 +1,62 @@
+import mmap
+import os
+import struct
+import time
+from typing import Iterable, List, Tuple
+
+MAGIC = b"freetar-snapshot-1\n"
+# key length, payload length, expiry (0: never), compressed
+RECORD = struct.Struct("<IIdB")
+
+# key, payload (pickled, maybe zlib compressed), compressed, expires
+Entry = Tuple[str, bytes, bool, float]
+
+
+def save(path: str, entries: Iterable[Entry]) -> Tuple[int, int]:
+    """Write cache entries to a snapshot file, returns the number of entries and bytes written
+
+    The file is replaced atomically, a crash while writing leaves the previous snapshot.
+    """
+    tmp = f"{path}.tmp"
+    count = 0
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        for key, payload, compressed, expires in entries:
+            key = key.encode()
+            f.write(RECORD.pack(len(key), len(payload), expires, compressed))
+            f.write(key)
+            f.write(payload)
+            count += 1
+        size = f.tell()
+    os.replace(tmp, path)
+    return count, size
+
+
+def load(path: str) -> List[Entry]:
+    """Read the entries of a snapshot file, in the order they were written, skipping expired ones"""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                print(f"Ignoring {path}, it's not a freetar snapshot")
+                return []
+            entries = []
+            now = time.time()
+            pos = len(MAGIC)
+            while pos + RECORD.size <= len(data):
+                key_length, payload_length, expires, compressed = RECORD.unpack_from(data, pos)
+                pos += RECORD.size
+                end = pos + key_length + payload_length
+                if end > len(data):
+                    print(f"{path} is truncated, loaded {len(entries)} entries")
+                    break
+                if not expires or expires > now:
+                    entries.append((data[pos:pos + key_length].decode(), data[pos + key_length:end],
+                                    bool(compressed), expires))
+                pos = end
+            return entries
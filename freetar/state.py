@@ -0,0 +1,120 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from freetar.store import (FavoritesStore, RecentShares, SQLiteFavoritesStore, SQLiteRecentShares,
+                           SQLiteStore)
+
+
+class LocalState:
+    """State of a single freetar process: favorites and recent shares in files, no pub/sub"""
+
+    def __init__(self, favorites_file: str, recent_shares_file: str, capacity: int):
+        self.favorites = FavoritesStore(favorites_file)
+        self.recent_shares = RecentShares(recent_shares_file, capacity=capacity)
+
+    def load(self):
+        self.favorites.load()
+        self.recent_shares.load()
+
+    def publish(self, message: dict):
+        """There are no other processes to tell"""
+
+    def subscribe(self, callback):
+        pass
+
+
+class SQLiteEvents(SQLiteStore):
+    """Pub/sub between freetar processes on one host, through a table in the shared database
+
+    publish() appends a message, a background thread of every process polls
+    for messages of the other processes and passes them to its callbacks.
+    Messages are kept for `retention` seconds. publish/subscribe is all
+    freetar needs, so a Redis channel could take this class' place.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.2, retention: float = 60):
+        super().__init__(path)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.origin = uuid.uuid4().hex
+        self._callbacks = []
+        self._thread = None
+        self._published = 0
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS events (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                origin TEXT NOT NULL,
+                                message TEXT NOT NULL,
+                                created REAL NOT NULL)""")
+
+    def publish(self, message: dict):
+        conn = self._connection()
+        conn.execute("INSERT INTO events (origin, message, created) VALUES (?, ?, ?)",
+                     (self.origin, json.dumps(message), time.time()))
+        self._published += 1
+        if self._published % 100 == 0:
+            conn.execute("DELETE FROM events WHERE created < ?", (time.time() - self.retention,))
+
+    def subscribe(self, callback):
+        self._callbacks.append(callback)
+        if self._thread is None:
+            # messages published from now on
+            last = self._connection().execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+            self._thread = threading.Thread(target=self._run, args=(last,), name="freetar-events", daemon=True)
+            self._thread.start()
+
+    def _run(self, last: int):
+        conn = self._connection()
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                rows = conn.execute("SELECT id, origin, message FROM events WHERE id > ? ORDER BY id",
+                                    (last,)).fetchall()
+            except sqlite3.Error as e:
+                print(f"Error reading events: {e}")
+                continue
+            for event_id, origin, message in rows:
+                last = event_id
+                if origin == self.origin:
+                    continue
+                for callback in self._callbacks:
+                    try:
+                        callback(json.loads(message))
+                    except Exception as e:
+                        print(f"Error handling event: {e}")
+
+
+class SQLiteState:
+    """State shared by all freetar processes using the same SQLite database
+
+    Favorites and recent shares live in the database, live shares are passed
+    on to the other processes through SQLiteEvents, so a share reaches the
+    websocket clients of every process.
+    """
+
+    def __init__(self, path: str, favorites_file: str, recent_shares_file: str, capacity: int):
+        self.favorites = SQLiteFavoritesStore(path, legacy_path=favorites_file)
+        self.recent_shares = SQLiteRecentShares(path, capacity=capacity, legacy_path=recent_shares_file)
+        self.events = SQLiteEvents(path)
+
+    def load(self):
+        self.favorites.load()
+        self.recent_shares.load()
+
+    def publish(self, message: dict):
+        self.events.publish(message)
+
+    def subscribe(self, callback):
+        self.events.subscribe(callback)
+
+
+def from_env(data_dir: str, favorites_file: str, recent_shares_file: str, capacity: int):
+    """FREETAR_STATE=sqlite shares favorites, recent shares and live shares between processes"""
+    if os.environ.get("FREETAR_STATE", "local") == "sqlite":
+        path = os.environ.get("FREETAR_STATE_PATH", os.path.join(data_dir, "freetar_state.sqlite3"))
+        return SQLiteState(path, favorites_file, recent_shares_file, capacity)
+    return LocalState(favorites_file, recent_shares_file, capacity)
@@ -265,14 +265,32 @@ document.querySelectorAll('.favorite').forEach(item => {
 
 // WebSocket connection
 let socket = null;
+let socketConnectedBefore = false;
+// With FREETAR_SERVER=async the websocket is at /ws on the same port, otherwise on the next port
+let socketSamePort = document.documentElement.dataset.server === 'async';
+
+function webSocketUrl() {
+    if (socketSamePort) {
+        const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+        return `${scheme}://${window.location.host}/ws`;
+    }
+    const wsPort = window.location.port ? parseInt(window.location.port) + 1 : 22002;
+    return `ws://${window.location.hostname}:${wsPort}`;
+}
 
-function connectWebSocket() {
+function connectWebSocket(retried = false) {
     if (!socket || socket.readyState !== WebSocket.OPEN) {
-        const wsPort = window.location.port ? parseInt(window.location.port) + 1 : 22002;
-        socket = new WebSocket(`ws://${window.location.hostname}:${wsPort}`);
-        
+        socket = new WebSocket(webSocketUrl());
+        let opened = false;
+
         socket.onopen = () => {
+            opened = true;
             console.log('WebSocket connected');
+            // Shares may have been missed while disconnected
+            if (socketConnectedBefore) {
+                loadLiveBanner();
+            }
+            socketConnectedBefore = true;
         };
 
         socket.onmessage = (event) => {
@@ -280,11 +298,20 @@ function connectWebSocket() {
             if (data.type === 'share_page') {
                 // Show a notification banner instead of immediately navigating
                 showShareNotification(data.url);
+            } else if (data.type === 'live') {
+                // The server pushes the live state whenever something was shared
+                applyLiveState(data);
             }
         };
 
         socket.onclose = () => {
             console.log('WebSocket disconnected');
+            if (!opened && !retried) {
+                // A cached page may come from a server that ran in the other mode, try the other address right away
+                socketSamePort = !socketSamePort;
+                connectWebSocket(true);
+                return;
+            }
             // Try to reconnect after 5 seconds
             setTimeout(connectWebSocket, 5000);
         };
@@ -314,9 +341,6 @@ function shareCurrentPage() {
                 artist_name: artist_name,
                 song_name: song_name
             })
-        }).then(() => {
-            // Refresh the live banner after sharing
-            loadLiveBanner();
         });
         
         socket.send(JSON.stringify({
@@ -400,9 +424,6 @@ function showShareNotification(url) {
             }
         }, 300);
     }, 5000);
-    
-    // Also refresh the live banner
-    loadLiveBanner();
 }
 
 function showRecentShares() {
@@ -553,8 +574,26 @@ function closeRecentSharesModal() {
     }
 }
 
+// Version of the live state the banner shows
+let liveVersion = null;
+
+function applyLiveState(data) {
+    if (data.version === liveVersion) {
+        return;
+    }
+    liveVersion = data.version;
+    // Only show banner if backend indicates it should be shown (within 5 minutes)
+    // AND the user is not currently on the same song page
+    if (data.latest && data.show_banner && data.latest.url !== window.location.pathname) {
+        showLiveBanner(data.latest.url, data.latest);
+    } else {
+        hideLiveBanner();
+    }
+}
+
 function loadLiveBanner() {
-    fetch('/api/live')
+    // Only the latest share is needed, the browser revalidates it with its ETag
+    fetch('/api/live?latest=1')
         .then(response => {
             if (response.ok) {
                 return response.json();
@@ -563,20 +602,7 @@ function loadLiveBanner() {
             }
         })
         .then(data => {
-            if (data.shares && data.shares.length > 0) {
-                const mostRecentShare = data.shares[0];
-                const currentPath = window.location.pathname;
-                
-                // Only show banner if backend indicates it should be shown (within 5 minutes)
-                // AND the user is not currently on the same song page
-                if (data.show_banner && mostRecentShare.url !== currentPath) {
-                    showLiveBanner(mostRecentShare.url, mostRecentShare);
-                } else {
-                    hideLiveBanner();
-                }
-            } else {
-                hideLiveBanner();
-            }
+            applyLiveState(data);
         })
         .catch(error => {
             hideLiveBanner();
@@ -0,0 +1,540 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from freetar.metrics import registry
+
+
+def persist_histogram(operation: str):
+    return registry.histogram("freetar_persist_seconds", "Time spent writing favorites and shares to disk",
+                              operation=operation)
+
+
+JOURNAL_SYNC_SECONDS = persist_histogram("favorites_sync")
+SNAPSHOT_SECONDS = persist_histogram("favorites_snapshot")
+SHARES_SAVE_SECONDS = persist_histogram("shares_save")
+
+
+class FavoritesStore:
+    """Shared favorites, persisted as a JSON snapshot plus an append-only journal.
+
+    Every add/remove appends one line to the journal instead of rewriting the
+    whole file. A background thread fsyncs the journal in batches and
+    periodically compacts it into a new snapshot, which is written to a temp
+    file and atomically renamed over the old one. On startup the snapshot is
+    loaded and the journal replayed on top of it.
+    """
+
+    def __init__(self, path: str, sync_interval: float = 1, compact_after: int = 1000,
+                 compact_interval: float = 300):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+        self.compact_interval = compact_interval
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._favorites = {}
+        self._journal = None
+        self._journal_entries = 0
+        self._unsynced = False
+        self._last_compaction = time.monotonic()
+        self._serialized = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        with self._lock:
+            favorites = {}
+            try:
+                if os.path.exists(self.path):
+                    with open(self.path, 'r') as f:
+                        favorites = json.load(f)
+            except Exception as e:
+                print(f"Error loading favorites: {e}")
+            # a journal left over from an interrupted compaction comes first
+            for journal in (self.journal_path + ".old", self.journal_path):
+                self._journal_entries += self._replay(journal, favorites)
+            self._favorites = favorites
+            self._serialized = None
+            self._journal = open(self.journal_path, 'a')
+        print(f"Loaded {len(self._favorites)} favorites from {self.path}")
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="freetar-favorites", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    @staticmethod
+    def _replay(journal: str, favorites: dict) -> int:
+        if not os.path.exists(journal):
+            return 0
+        entries = 0
+        with open(journal, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line may be incomplete after a crash
+                    break
+                if entry["op"] == "add":
+                    favorites[entry["key"]] = entry["value"]
+                else:
+                    favorites.pop(entry["key"], None)
+                entries += 1
+        return entries
+
+    def _append(self, entry: dict):
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal_entries += 1
+        self._unsynced = True
+        self._serialized = None
+
+    def add(self, key: str, value: dict):
+        with self._lock:
+            self._favorites[key] = value
+            self._append({"op": "add", "key": key, "value": value})
+
+    def remove(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._favorites:
+                return False
+            del self._favorites[key]
+            self._append({"op": "remove", "key": key})
+            return True
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._favorites
+
+    def __len__(self) -> int:
+        return len(self._favorites)
+
+    def as_dict(self) -> dict:
+        """A copy of all favorites, by tab URL"""
+        with self._lock:
+            return dict(self._favorites)
+
+    def serialized(self) -> str:
+        """All favorites as JSON, only serialized again after they changed"""
+        serialized = self._serialized
+        if serialized is None:
+            with self._lock:
+                serialized = self._serialized = json.dumps(self._favorites, sort_keys=True,
+                                                           separators=(",", ":")) + "\n"
+        return serialized
+
+    def sync(self):
+        with self._lock:
+            if self._unsynced:
+                with JOURNAL_SYNC_SECONDS.time():
+                    self._journal.flush()
+                    os.fsync(self._journal.fileno())
+                self._unsynced = False
+
+    def compact(self):
+        """Write all favorites into a new snapshot and start with an empty journal"""
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self):
+        old_journal = self.journal_path + ".old"
+        with self._lock:
+            # an old journal is left over from a failed snapshot, which has to be retried
+            if not self._journal_entries and not os.path.exists(old_journal):
+                return
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal.close()
+            if os.path.exists(old_journal):
+                # the last snapshot failed, the old journal still holds changes that aren't in the snapshot
+                with open(self.journal_path, 'r') as src, open(old_journal, 'a') as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, old_journal)
+            self._journal = open(self.journal_path, 'a')
+            self._journal_entries = 0
+            self._unsynced = False
+            favorites = dict(self._favorites)
+            self._last_compaction = time.monotonic()
+
+        tmp = self.path + ".tmp"
+        with SNAPSHOT_SECONDS.time():
+            with open(tmp, 'w') as f:
+                json.dump(favorites, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        os.remove(old_journal)
+        print(f"Saved {len(favorites)} favorites to {self.path}")
+
+    def _run(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.sync()
+                if self._journal_entries >= self.compact_after or \
+                        time.monotonic() - self._last_compaction >= self.compact_interval:
+                    self.compact()
+            except Exception as e:
+                print(f"Error saving favorites: {e}")
+
+    def close(self):
+        self._stop.set()
+        try:
+            self.compact()
+            self.sync()
+        except Exception as e:
+            print(f"Error saving favorites: {e}")
+
+
+class RecentShares:
+    """The most recently shared songs, newest first, without duplicate URLs.
+
+    Shares live in a ring buffer twice the size of `capacity`, a URL that is
+    shared again leaves an empty slot behind (once the ring is full, the shares
+    are moved together). A dict maps every URL to its slot,
+    so deduplication is O(1), and the share times in the ring are
+    non-decreasing, so finding the shares of the last n minutes is a binary
+    search. Changes are written to disk by a timer `save_delay` seconds after
+    the first change, so a burst of shares costs one write. `version` goes up
+    with every share, clients use it to tell whether they are up to date.
+    """
+
+    def __init__(self, path: str, capacity: int = 100, save_delay: float = 2):
+        self.path = path
+        self.capacity = capacity
+        self.save_delay = save_delay
+        self._size = capacity * 2
+        self._slots = [None] * self._size
+        self._times = [0.0] * self._size
+        self._head = 0  # sequence number of the next share, its slot is head % size
+        self._tail = 0  # no live share is older than this sequence number
+        self._index = {}
+        self._live = 0
+        self.version = 0
+        # versions start over when the process restarts
+        self.epoch = format(int(time.time()), "x")
+        self._lock = threading.RLock()
+        self._save_timer = None
+
+    def load(self):
+        shares = []
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    shares = json.load(f)
+                print(f"Loaded {len(shares)} recent shares from {self.path}")
+            else:
+                print(f"No recent shares file found, starting with empty list")
+        except Exception as e:
+            print(f"Error loading recent shares: {e}")
+        with self._lock:
+            for share in reversed(shares):
+                try:
+                    shared_at = datetime.fromisoformat(share["timestamp"]).timestamp()
+                except (KeyError, TypeError, ValueError):
+                    shared_at = 0.0
+                self._add(share, shared_at)
+        atexit.register(self.save)
+
+    def _slot(self, seq: int) -> int:
+        return seq % self._size
+
+    def _drop(self, seq: int):
+        slot = self._slot(seq)
+        del self._index[self._slots[slot]["url"]]
+        self._slots[slot] = None
+        self._live -= 1
+
+    def _add(self, share: dict, shared_at: float):
+        if share["url"] in self._index:
+            self._drop(self._index[share["url"]])
+        # times have to be non-decreasing for the binary search
+        if self._head:
+            shared_at = max(shared_at, self._times[self._slot(self._head - 1)])
+        if self._head >= self._size and self._slots[self._slot(self._head)] is not None:
+            # the ring is full of shares and empty slots, move the shares together
+            self._compact()
+        slot = self._slot(self._head)
+        self._slots[slot] = share
+        self._times[slot] = shared_at
+        self._index[share["url"]] = self._head
+        self._head += 1
+        self._live += 1
+        self._tail = max(self._tail, self._head - self._size)
+        while self._live > self.capacity:
+            if self._slots[self._slot(self._tail)] is not None:
+                self._drop(self._tail)
+            self._tail += 1
+
+    def _compact(self):
+        live = [(self._slots[self._slot(seq)], self._times[self._slot(seq)])
+                for seq in range(self._tail, self._head)
+                if self._slots[self._slot(seq)] is not None]
+        self._slots = [None] * self._size
+        self._index = {}
+        for seq, (share, shared_at) in enumerate(live):
+            self._slots[seq] = share
+            self._times[seq] = shared_at
+            self._index[share["url"]] = seq
+        self._head = len(live)
+        self._tail = 0
+
+    def add(self, share: dict) -> int:
+        """Add a share, returns the new version"""
+        with self._lock:
+            self._add(share, time.time())
+            self.version += 1
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self.save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+            return self.version
+
+    def _newest_first(self, oldest: int) -> list:
+        return [self._slots[self._slot(seq)]
+                for seq in range(self._head - 1, oldest - 1, -1)
+                if self._slots[self._slot(seq)] is not None]
+
+    def shares(self) -> list:
+        with self._lock:
+            return self._newest_first(self._tail)
+
+    def shares_since(self, since: float) -> list:
+        """Shares of the time since `since` (a time.time() timestamp), newest first"""
+        with self._lock:
+            lo, hi = self._tail, self._head
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._times[self._slot(mid)] < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return self._newest_first(lo)
+
+    def latest(self):
+        """The newest share and its time, or (None, None)"""
+        with self._lock:
+            for seq in range(self._head - 1, self._tail - 1, -1):
+                slot = self._slot(seq)
+                if self._slots[slot] is not None:
+                    return self._slots[slot], self._times[slot]
+            return None, None
+
+    def latest_version(self):
+        """The version, the newest share and its time, (version, None, None) without shares"""
+        with self._lock:
+            return (self.version, *self.latest())
+
+    def __len__(self) -> int:
+        return self._live
+
+    def save(self):
+        with self._lock:
+            self._save_timer = None
+            shares = self._newest_first(self._tail)
+        try:
+            tmp = self.path + ".tmp"
+            with SHARES_SAVE_SECONDS.time():
+                with open(tmp, 'w') as f:
+                    json.dump(shares, f, indent=2)
+                os.replace(tmp, self.path)
+            print(f"Saved {len(shares)} recent shares to {self.path}")
+        except Exception as e:
+            print(f"Error saving recent shares: {e}")
+
+
+class SQLiteStore:
+    """Base of the stores kept in a SQLite database shared by several freetar processes
+
+    Like the SQLite cache, the database runs in WAL mode and every thread
+    gets its own connection. Every store keeps a version number in the
+    `versions` table, which goes up with every change.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def _version(self, conn: sqlite3.Connection, name: str) -> int:
+        row = conn.execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def _bump(self, conn: sqlite3.Connection, name: str) -> int:
+        conn.execute("INSERT INTO versions VALUES (?, 1) "
+                     "ON CONFLICT (name) DO UPDATE SET version = version + 1", (name,))
+        return self._version(conn, name)
+
+
+class SQLiteFavoritesStore(SQLiteStore):
+    """Shared favorites in a SQLite database, same interface as FavoritesStore
+
+    On first use, the favorites of an existing FavoritesStore at `legacy_path`
+    are imported.
+    """
+
+    def __init__(self, path: str, legacy_path: str = None):
+        super().__init__(path)
+        self.legacy_path = legacy_path
+        self._serialized = (None, None)
+
+    def load(self):
+        conn = self._connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS favorites (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # only into a database that never had any favorites
+            if not self._version(conn, "favorites") and self.legacy_path:
+                favorites = {}
+                try:
+                    if os.path.exists(self.legacy_path):
+                        with open(self.legacy_path, 'r') as f:
+                            favorites = json.load(f)
+                except Exception as e:
+                    print(f"Error loading favorites: {e}")
+                for journal in (self.legacy_path + ".journal.old", self.legacy_path + ".journal"):
+                    FavoritesStore._replay(journal, favorites)
+                conn.executemany("INSERT INTO favorites VALUES (?, ?)",
+                                 [(key, json.dumps(value)) for key, value in favorites.items()])
+                if favorites:
+                    self._bump(conn, "favorites")
+        print(f"Loaded {len(self)} favorites from {self.path}")
+
+    def add(self, key: str, value: dict):
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("INSERT OR REPLACE INTO favorites VALUES (?, ?)", (key, json.dumps(value)))
+            self._bump(conn, "favorites")
+
+    def remove(self, key: str) -> bool:
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN")
+            if not conn.execute("DELETE FROM favorites WHERE key = ?", (key,)).rowcount:
+                return False
+            self._bump(conn, "favorites")
+            return True
+
+    def __contains__(self, key: str) -> bool:
+        return self._connection().execute("SELECT 1 FROM favorites WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM favorites").fetchone()[0]
+
+    def as_dict(self) -> dict:
+        """All favorites, by tab URL"""
+        return {key: json.loads(value)
+                for key, value in self._connection().execute("SELECT key, value FROM favorites")}
+
+    def serialized(self) -> str:
+        """All favorites as JSON, only serialized again after they changed in any process"""
+        conn = self._connection()
+        version, serialized = self._serialized
+        if version != self._version(conn, "favorites") or serialized is None:
+            with conn:
+                conn.execute("BEGIN")
+                version = self._version(conn, "favorites")
+                favorites = self.as_dict()
+            serialized = json.dumps(favorites, sort_keys=True, separators=(",", ":")) + "\n"
+            self._serialized = (version, serialized)
+        return serialized
+
+    def close(self):
+        pass
+
+
+class SQLiteRecentShares(SQLiteStore):
+    """The most recently shared songs in a SQLite database, same interface as RecentShares"""
+
+    def __init__(self, path: str, capacity: int = 100, legacy_path: str = None):
+        super().__init__(path)
+        self.capacity = capacity
+        self.legacy_path = legacy_path
+        self.epoch = "db"
+
+    def load(self):
+        conn = self._connection()
+        conn.execute("""CREATE TABLE IF NOT EXISTS shares (
+                            url TEXT PRIMARY KEY,
+                            share TEXT NOT NULL,
+                            shared_at REAL NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS shares_shared_at ON shares (shared_at)")
+        if not self.version and self.legacy_path and os.path.exists(self.legacy_path):
+            try:
+                with open(self.legacy_path, 'r') as f:
+                    shares = json.load(f)
+                with conn:
+                    conn.execute("BEGIN")
+                    for share in reversed(shares):
+                        try:
+                            shared_at = datetime.fromisoformat(share["timestamp"]).timestamp()
+                        except (KeyError, TypeError, ValueError):
+                            shared_at = 0.0
+                        conn.execute("INSERT OR REPLACE INTO shares VALUES (?, ?, ?)",
+                                     (share["url"], json.dumps(share), shared_at))
+                    self._bump(conn, "shares")
+            except Exception as e:
+                print(f"Error loading recent shares: {e}")
+        print(f"Loaded {len(self)} recent shares from {self.path}")
+
+    def add(self, share: dict) -> int:
+        """Add a share, returns the new version"""
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            latest = conn.execute("SELECT MAX(shared_at) FROM shares").fetchone()[0] or 0.0
+            # times have to be non-decreasing, like in RecentShares
+            conn.execute("INSERT OR REPLACE INTO shares VALUES (?, ?, ?)",
+                         (share["url"], json.dumps(share), max(time.time(), latest)))
+            conn.execute("DELETE FROM shares WHERE url NOT IN "
+                         "(SELECT url FROM shares ORDER BY shared_at DESC LIMIT ?)", (self.capacity,))
+            return self._bump(conn, "shares")
+
+    @property
+    def version(self) -> int:
+        return self._version(self._connection(), "shares")
+
+    def shares(self) -> list:
+        return [json.loads(share) for share, in
+                self._connection().execute("SELECT share FROM shares ORDER BY shared_at DESC")]
+
+    def shares_since(self, since: float) -> list:
+        """Shares of the time since `since` (a time.time() timestamp), newest first"""
+        return [json.loads(share) for share, in
+                self._connection().execute("SELECT share FROM shares WHERE shared_at >= ? "
+                                           "ORDER BY shared_at DESC", (since,))]
+
+    def latest(self):
+        """The newest share and its time, or (None, None)"""
+        row = self._connection().execute("SELECT share, shared_at FROM shares "
+                                         "ORDER BY shared_at DESC LIMIT 1").fetchone()
+        return (json.loads(row[0]), row[1]) if row else (None, None)
+
+    def latest_version(self):
+        """The version, the newest share and its time, (version, None, None) without shares"""
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN")
+            return (self._version(conn, "shares"), *self.latest())
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM shares").fetchone()[0]
+
+    def save(self):
+        pass
@@ -1,20 +1,130 @@
-import cloudscraper
 import requests
-from bs4 import BeautifulSoup
 from urllib.parse import quote, urlparse
+import html
 import json
+import marshal
+import os
 import re
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from .utils import FreetarError
+from functools import lru_cache
+from typing import Iterable, List, Tuple
+from .metrics import registry, timed
+from .upstream import CircuitBreaker, ScraperPool, UpstreamScheduler
+from .utils import FreetarError, SingleFlight, UpstreamUnavailable
 
-scraper = cloudscraper.create_scraper()
+scraper = ScraperPool.from_env()
+breaker = CircuitBreaker.from_env()
+# every request to UG waits for its turn here
+scheduler = UpstreamScheduler.from_env()
+
+# concurrent requests for the same tab/search page share one upstream fetch
+tab_flight = SingleFlight()
+search_flight = SingleFlight()
+
+UPSTREAM_SECONDS = registry.histogram("freetar_upstream_request_seconds", "Duration of requests to Ultimate Guitar")
+UPSTREAM_WAIT_SECONDS = {priority: registry.histogram("freetar_upstream_wait_seconds",
+                                                      "Time requests to Ultimate Guitar waited for their turn",
+                                                      priority=name)
+                         for priority, name in UpstreamScheduler.PRIORITIES.items()}
+UPSTREAM_FAILURES = registry.counter("freetar_upstream_failures_total",
+                                     "Requests to Ultimate Guitar that failed or were blocked")
+
+
+def stage_histogram(stage: str):
+    return registry.histogram("freetar_stage_seconds", "Time spent in each processing stage", stage=stage)
+
+
+# Where UG is. FREETAR_UG_URL points freetar at another server, e.g. the stub of the benchmarks
+UG_URL = os.environ.get("FREETAR_UG_URL", "http://www.ultimate-guitar.com")
+UG_TABS_URL = os.environ.get("FREETAR_UG_URL", "https://tabs.ultimate-guitar.com")
 
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.3"
 
 
+# attribute inside a start tag: name, optionally followed by a double/single/unquoted value
+ATTRIBUTE_RE = re.compile(r"""\s*([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?""")
+
+
+def _tag_attributes(page: str, pos: int) -> dict:
+    attributes = {}
+    while True:
+        match = ATTRIBUTE_RE.match(page, pos)
+        if match is None:
+            return attributes
+        name, double, single, unquoted = match.groups()
+        value = double if double is not None else single if single is not None else unquoted
+        attributes[name.lower()] = html.unescape(value) if value is not None else ""
+        pos = match.end()
+
+
+def _extract_store_fast(page: str):
+    pos = page.find("js-store")
+    while pos != -1:
+        start = page.rfind("<", 0, pos)
+        if page.startswith("<div", start) and page[start + 4:start + 5].isspace():
+            attributes = _tag_attributes(page, start + 4)
+            if "js-store" in attributes.get("class", "").split() and "data-content" in attributes:
+                return json.loads(attributes["data-content"])
+        pos = page.find("js-store", pos + len("js-store"))
+    return None
+
+
+def _extract_store_soup(page: str) -> dict:
+    # only needed when the fast path fails, so BeautifulSoup is imported on first use
+    from bs4 import BeautifulSoup, SoupStrainer
+    bs = BeautifulSoup(page, 'html.parser', parse_only=SoupStrainer("div", class_="js-store"))
+    data = bs.find("div", {"class": "js-store"}) # data can be None
+    return json.loads(data.attrs['data-content']) # KeyError
+
+
+@timed(stage_histogram("extract"))
+def extract_store(page: str) -> dict:
+    """Get the JSON data of an UG page, which is stored in the data-content attribute of div.js-store
+
+    Scans for the single attribute we need instead of parsing the whole page.
+    If that fails, the page is parsed with BeautifulSoup.
+    """
+    try:
+        data = _extract_store_fast(page)
+        if data is not None:
+            return data
+    except ValueError:
+        pass
+    return _extract_store_soup(page)
+
+
+def fetch(url: str, kind: str) -> requests.Response:
+    """Get a page from UG when the scheduler lets it through, unless UG failed too often recently"""
+    # don't wait for a turn just to be refused
+    if breaker.refuses():
+        raise UpstreamUnavailable("Ultimate Guitar is not reachable at the moment. Please try again later.")
+    try:
+        UPSTREAM_WAIT_SECONDS[scheduler.current_priority()].observe(scheduler.acquire(kind))
+    except TimeoutError as e:
+        raise UpstreamUnavailable("Too many requests to Ultimate Guitar at the moment. Please try again later.") from e
+    if not breaker.allow():
+        raise UpstreamUnavailable("Ultimate Guitar is not reachable at the moment. Please try again later.")
+    try:
+        with UPSTREAM_SECONDS.time():
+            resp = scraper.get(url, headers={'User-Agent': USER_AGENT})
+    except requests.exceptions.RequestException:
+        breaker.failure()
+        UPSTREAM_FAILURES.inc()
+        raise
+    if resp.status_code in (403, 429) or resp.status_code >= 500:
+        breaker.failure()
+        UPSTREAM_FAILURES.inc()
+    else:
+        breaker.success()
+    return resp
+
+
 @dataclass
 class SearchResult:
+    __slots__ = ("artist_name", "song_name", "tab_url", "artist_url", "_type", "version", "votes", "rating")
+
     artist_name: str
     song_name: str
     tab_url: str
@@ -37,6 +147,17 @@ class SearchResult:
     def __repr__(self):
         return f"{self.artist_name} - {self.song_name} (ver {self.version}) ({self._type} {self.rating}/5 - {self.votes} votes)"
 
+    def to_record(self) -> tuple:
+        return (self.artist_name, self.song_name, self.tab_url, self.artist_url,
+                self._type, self.version, self.votes, self.rating)
+
+    @classmethod
+    def from_record(cls, record: tuple) -> "SearchResult":
+        s = cls.__new__(cls)
+        (s.artist_name, s.song_name, s.tab_url, s.artist_url,
+         s._type, s.version, s.votes, s.rating) = record
+        return s
+
 
 @dataclass
 class SongDetail:
@@ -75,37 +196,97 @@ class SongDetail:
     def __repr__(self):
         return f"{self.artist_name} - {self.song_name}"
 
+    # bump when the record layout or the output of fix_tab/get_chords changes
+    RECORD_VERSION = 1
+
+    def to_bytes(self) -> bytes:
+        """Serialize the parsed song (already fixed tab, chords) into a compact binary record"""
+        record = (self.RECORD_VERSION, self.tab, self.artist_name, self.song_name, self.version,
+                  self._type, self.rating, self.difficulty, getattr(self, "capo", None),
+                  getattr(self, "tuning", None), self.tab_url,
+                  tuple(alternative.to_record() for alternative in self.alternatives),
+                  self.chords, self.fingers_for_strings)
+        return marshal.dumps(record)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "SongDetail":
+        record = marshal.loads(data)
+        if record[0] != cls.RECORD_VERSION:
+            raise ValueError(f"Unsupported SongDetail record version {record[0]}")
+        s = cls.__new__(cls)
+        (_, s.tab, s.artist_name, s.song_name, s.version, s._type, s.rating, s.difficulty,
+         s.capo, s.tuning, s.tab_url, alternatives, s.chords, s.fingers_for_strings) = record
+        s.alternatives = [SearchResult.from_record(alternative) for alternative in alternatives]
+        s.appliciture = None
+        return s
+
+    def to_search_result(self) -> SearchResult:
+        """The song as a row of a search result, UG doesn't tell the votes of a tab"""
+        s = SearchResult.__new__(SearchResult)
+        s.artist_name, s.song_name, s.tab_url = self.artist_name, self.song_name, urlparse(self.tab_url).path
+        s.artist_url, s._type, s.version, s.votes, s.rating = "", self._type, self.version, 0, self.rating
+        return s
+
+    @timed(stage_histogram("fix_tab"))
     def fix_tab(self):
-        tab = self.tab
-
-        # remove lines that look like a guitar tab line
-        tab = re.sub(r"[a-zA-Z][\|\-\:].*\n?", "", tab, flags=re.MULTILINE) # filters `e|-1-2-3-` or `e:1-2-3-` or `e-1-2-3-`
-
-        tab = tab.replace("\r\n", "<br/>")
-        tab = tab.replace("\n", "<br/>")
-        tab = tab.replace(" ", "&nbsp;")
-        tab = tab.replace("[tab]", "")
-        tab = tab.replace("[/tab]", "")
-
-        # create non wrappable blocks
-        tab = re.sub(r"<br/>(&nbsp;)*<br/>", "</div><div class='tab-block'>", tab)
-
-        # (?P<root>[A-Ha-h](#|b)?) : Chord root is any letter A - H with an optional sharp or flat at the end
-        # (?P<quality>[^[/]+)?  : Chord quality is anything after the root, but before the `/` for the base note
-        # (?P<bass>/[A-Ha-h](#|b)?)? :  Chord quality is anything after the root, including parens in the case of 'm(maj7)'
-        # tab = re.sub(r'\[ch\](?P<root>[A-Ga-g](#|b)?)(?P<quality>[#\w()]+)?(?P<bass>/[A-Ga-g](#|b)?)?\[\/ch\]', self.parse_chord, tab)
-        tab = re.sub(r'\[ch\](?P<root>[A-Ha-h](#|b)?)(?P<quality>[^[/]+)?(?P<bass>/[A-Ha-h](#|b)?)?\[\/ch\]', self.parse_chord, tab)
-        self.tab = "<div class='tab-block'>" + tab + "</div>"
-
-    def parse_chord(self, chord):
-        root = '<span class="chord-root">%s</span>' % chord.group('root')
-        quality = ''
-        bass = ''
-        if chord.group('quality') is not None:
-            quality = '<span class="chord-quality">%s</span>' % chord.group('quality')
-        if chord.group('bass') is not None:
-            bass = '/<span class="chord-bass">%s</span>' % chord.group('bass')[1:]
-        return '<span class="chord fw-bold">%s</span>' % (root + quality + bass)
+        self.tab = "".join(render_tab(self.tab))
+
+
+# lines that look like a guitar tab line, they are removed
+TAB_LINE_RE = re.compile(r"[a-zA-Z][\|\-\:].*\n?") # filters `e|-1-2-3-` or `e:1-2-3-` or `e-1-2-3-`
+
+# Tokens of the markup, everything in between is copied:
+# <br/>(&nbsp;)*<br/> : empty line, it splits the tab into non wrappable blocks
+# \[ch\]...\[/ch\]      : chord
+#   (?P<root>[A-Ha-h](#|b)?) : Chord root is any letter A - H with an optional sharp or flat at the end
+#   (?P<quality>[^[/]+)?  : Chord quality is anything after the root, but before the `/` for the base note,
+#                           including parens in the case of 'm(maj7)'
+#   (?P<bass>/[A-Ha-h](#|b)?)? : Bass note after the `/`
+# Both alternatives start with a literal, which lets the regex engine skip ahead quickly.
+TAB_TOKEN_RE = re.compile(r"<br/>(?:&nbsp;)*<br/>"
+                          r"|\[ch\](?P<root>[A-Ha-h][#b]?)(?P<quality>[^[/]+)?(?P<bass>/[A-Ha-h][#b]?)?\[/ch\]")
+
+BLOCK_BREAK = "</div><div class='tab-block'>"
+
+
+@lru_cache(maxsize=4096)
+def render_chord(root: str, quality: str, bass: str) -> str:
+    root = '<span class="chord-root">%s</span>' % root
+    quality = '<span class="chord-quality">%s</span>' % quality if quality is not None else ''
+    bass = '/<span class="chord-bass">%s</span>' % bass[1:] if bass is not None else ''
+    return '<span class="chord fw-bold">%s</span>' % (root + quality + bass)
+
+
+def render_tab(tab: str):
+    """Turn the UG wiki markup of a tab into HTML, yielding it in chunks
+
+    Tab lines and [tab] markers are dropped, line breaks become <br/>, spaces
+    &nbsp; and chords styled spans. Empty lines (only whitespace) split the tab
+    into non wrappable blocks. The output is the same as the former chain of
+    regex/replace passes, see benchmarks/bench_render.py.
+    """
+    # Removing tab lines and markers joins the text around them and line breaks
+    # are turned into <br/> before the markers are removed, so these are done in
+    # this order upfront. They are plain string operations, done in C.
+    tab = TAB_LINE_RE.sub("", tab)
+    tab = (tab.replace("\r\n", "<br/>")
+              .replace("\n", "<br/>")
+              .replace(" ", "&nbsp;")
+              .replace("[tab]", "")
+              .replace("[/tab]", ""))
+
+    # blocks and chords are handled in a single scan, chords are rendered once per distinct chord
+    yield "<div class='tab-block'>"
+    pos = 0
+    for token in TAB_TOKEN_RE.finditer(tab):
+        yield tab[pos:token.start()]
+        pos = token.end()
+        if token.group("root") is None:
+            yield BLOCK_BREAK
+        else:
+            yield render_chord(*token.group("root", "quality", "bass"))
+    yield tab[pos:]
+    yield "</div>"
 
 
 @dataclass
@@ -114,14 +295,12 @@ class Search:
     total_pages: int
     current_page: int
 
+    @timed(stage_histogram("search"))
     def __init__(self, value: str, page: int):
         try:
-            resp = scraper.get(f"http://www.ultimate-guitar.com/search.php?page={page}&search_type=title&value={quote(value)}",
-                               headers={'User-Agent': USER_AGENT})
+            resp = fetch(f"{UG_URL}/search.php?page={page}&search_type=title&value={quote(value)}", "search")
             resp.raise_for_status()
-            bs = BeautifulSoup(resp.text, 'html.parser') # data can be None
-            data = bs.find("div", {"class": "js-store"}) # KeyError
-            data = json.loads(data.attrs['data-content'])
+            data = extract_store(resp.text)
             self.results = self.get_results(data)
             self.total_pages = data['store']['page']['data']['pagination']['total']
             self.current_page = data['store']['page']['data']['pagination']['current']
@@ -132,6 +311,13 @@ class Search:
         except (KeyError, ValueError, AttributeError) as e:
             raise FreetarError(f"Could not search for chords: {e}") from e
 
+    @classmethod
+    def from_results(cls, results: list, total_pages: int, current_page: int) -> "Search":
+        """A search answered without UG"""
+        s = cls.__new__(cls)
+        s.results, s.total_pages, s.current_page = results, total_pages, current_page
+        return s
+
     def get_results(self, data: object):
         results = data['store']['page']['data']['results']
         ug_results = []
@@ -143,6 +329,46 @@ class Search:
         return ug_results
 
 
+# a chord diagram has at least this many fret rows
+MIN_FRET_ROWS = 6
+
+
+@lru_cache(maxsize=4096)
+def chord_shape(frets: tuple, fingers: tuple):
+    """Compute the diagram of a chord variant, shared by all tabs using the same shape
+
+    Returns None if no string is fretted. Otherwise (first fret, one bitmask of
+    the pressed strings per fret row, number of strings, number of empty rows
+    to add, fingering). Strings are in reverse order of `frets`, bit i is string i.
+    """
+    last_fret = max(frets)
+    strings = frets[::-1]
+    fretted = [fret for fret in strings if fret > 0]
+    if not fretted:
+        return None
+    first_fret = min(fretted)
+    masks = [0] * (last_fret - first_fret + 1)
+    for string, fret in enumerate(strings):
+        if fret > 0:
+            masks[fret - first_fret] |= 1 << string
+    padding = max(0, MIN_FRET_ROWS - len(masks))
+
+    pressed = 0
+    for mask in masks:
+        pressed |= mask
+    # empty rows are 6 strings wide, a string beyond that counts as not strummed
+    width = min(len(strings), 6) if padding else len(strings)
+    fingering = tuple("x" if not pressed >> string & 1 else finger
+                      for string, finger in zip(range(width), fingers[::-1]))
+    return first_fret, tuple(masks), len(strings), padding, fingering
+
+
+@lru_cache(maxsize=1024)
+def fret_row(mask: int, strings: int) -> tuple:
+    return tuple(mask >> string & 1 for string in range(strings))
+
+
+@timed(stage_histogram("get_chords"))
 def get_chords(s: SongDetail) -> SongDetail:
     if s.appliciture is None:
         return dict(), dict()
@@ -152,61 +378,89 @@ def get_chords(s: SongDetail) -> SongDetail:
 
     for chord in s.appliciture:
         for chord_variant in s.appliciture[chord]:
-            frets = chord_variant["frets"]
-            min_fret = min(frets)
-            max_fret = max(frets)
-            possible_frets = list(range(min_fret, max_fret+1))
-            variants_temp = {
-                possible_fret: [1 if b == possible_fret else 0 for b in frets][::-1]
-                for possible_fret
-                in possible_frets
-                if possible_fret > 0
-            }
-
-            variants = dict()
-            found = False
-            for fret, fingers in variants_temp.items():
-                try:
-                    if not found and fingers.index(1) >= 0:
-                        found = True
-                except ValueError:
-                    ...
-
-                if found:
-                    variants[fret] = fingers
-
-            if not len(variants):
+            shape = chord_shape(tuple(chord_variant["frets"]), tuple(chord_variant["fingers"]))
+            if shape is None:
                 continue
-            while len(variants) < 6:
-                variants[max(variants) + 1] = [0] * 6
+            first_fret, masks, strings, padding, fingering = shape
 
-            variant_strings_pressed = [*variants.values()]
-            variant_strings_pressed = [sum(x) for x in zip(*variant_strings_pressed)]
-            unstrummed_strings = [int(not bool(y)) for y in variant_strings_pressed]
-
-            fingering_for_variant = []
-            for finger, x in zip(chord_variant["fingers"][::-1], unstrummed_strings):
-                fingering_for_variant.append("x" if x else finger)
-            fingering_for_variant = fingering_for_variant
+            variants = {fret: list(fret_row(mask, strings)) for fret, mask in enumerate(masks, first_fret)}
+            for fret in range(first_fret + len(masks), first_fret + len(masks) + padding):
+                variants[fret] = [0] * 6
 
             if chord not in chords:
                 chords[chord] = []
                 fingerings[chord] = []
             chords[chord].append(variants)
-            fingerings[chord].append(fingering_for_variant)
+            fingerings[chord].append(list(fingering))
 
     return chords, fingerings
 
 
-def ug_tab(url_path: str):
+def ug_search(value: str, page: int) -> Search:
+    return search_flight.do((value, page), Search, value, page)
+
+
+# fetches the further pages of an aggregated search, at most as many at once as UG gets requests per host
+search_pages_pool = ThreadPoolExecutor(max_workers=scraper.per_host, thread_name_prefix="freetar-search")
+
+
+def result_score(result: SearchResult) -> float:
+    """Rating, weighted by the number of votes: 5 stars from 2 votes rank below 4.8 from 500"""
+    return result.rating * result.votes / (result.votes + 10)
+
+
+def merge_results(results: Iterable[SearchResult]) -> List[SearchResult]:
+    """Drop duplicate tabs and group the versions of a song, best song and best version first"""
+    songs = {}
+    seen = set()
+    for result in results:
+        if result.tab_url in seen:
+            continue
+        seen.add(result.tab_url)
+        songs.setdefault((result.artist_name.lower(), result.song_name.lower()), []).append(result)
+    for versions in songs.values():
+        versions.sort(key=lambda r: (result_score(r), r.votes), reverse=True)
+    ranked = sorted(songs.values(), key=lambda versions: (result_score(versions[0]), versions[0].votes), reverse=True)
+    return [result for versions in ranked for result in versions]
+
+
+def _search_page(priority: int, value: str, page: int) -> Search:
+    with scheduler.priority(priority):
+        return ug_search(value, page)
+
+
+@timed(stage_histogram("aggregate_search"))
+def aggregate_search(value: str, pages: int) -> Tuple[List[SearchResult], int]:
+    """Search the first `pages` result pages of UG at once and merge them
+
+    Returns the merged results and the number of pages fetched. The first
+    page tells how many there are, the others are fetched concurrently. If
+    one of them fails, the results of the others are still used.
+    """
+    first = ug_search(value, 1)
+    searches = [first]
+    more = range(2, min(pages, first.total_pages) + 1)
+    if more and breaker.state == "closed":
+        priority = scheduler.current_priority()
+        futures = [search_pages_pool.submit(_search_page, priority, value, page) for page in more]
+        for page, future in zip(more, futures):
+            try:
+                searches.append(future.result())
+            except FreetarError as e:
+                print(f"Could not get page {page} of the search for '{value}': {e}")
+    return merge_results(r for search in searches for r in search.results), len(searches)
+
+
+def ug_tab(url_path: str) -> SongDetail:
+    return tab_flight.do(str(url_path), _ug_tab, url_path)
+
+
+@timed(stage_histogram("tab"))
+def _ug_tab(url_path: str) -> SongDetail:
     try:
-        resp = scraper.get("https://tabs.ultimate-guitar.com/tab/" + url_path,
-                           headers={'User-Agent': USER_AGENT})
+        resp = fetch(f"{UG_TABS_URL}/tab/{url_path}", "tab")
         resp.raise_for_status()
-        bs = BeautifulSoup(resp.text, 'html.parser')
-        data = bs.find("div", {"class": "js-store"})
-        data = data.attrs['data-content']
-        data = json.loads(data)
+        data = extract_store(resp.text)
         s = SongDetail(data)
         s.chords, s.fingers_for_strings = get_chords(s)
         return s
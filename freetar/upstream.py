@@ -0,0 +1,336 @@
+import bisect
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+
+class ScraperPool:
+    """Pool of cloudscraper sessions shared by the waitress threads.
+
+    A requests session (and the Cloudflare state cloudscraper keeps in it) must
+    not be used by several threads at once, so every request checks out its own
+    session and returns it afterwards. Sessions keep their connections alive.
+    A session that got challenged or answered with 403 is thrown away and
+    replaced by a fresh one. Concurrent requests per host are limited and every
+    request has a timeout, so a hanging upstream can't pin a thread forever.
+    """
+
+    def __init__(self,
+                 size: int = 4,
+                 per_host: int = 4,
+                 timeout: float = 10,
+                 connect_timeout: float = 5):
+        self.size = size
+        self.per_host = per_host
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._sessions = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._host_limits = {}
+        self.replaced = 0
+
+    @classmethod
+    def from_env(cls) -> "ScraperPool":
+        threads = int(os.environ.get("THREADS", "4"))
+        return cls(size=int(os.environ.get("FREETAR_UPSTREAM_POOL", threads)),
+                   per_host=int(os.environ.get("FREETAR_UPSTREAM_PER_HOST", threads)),
+                   timeout=float(os.environ.get("FREETAR_UPSTREAM_TIMEOUT", "10")))
+
+    def _new_session(self) -> requests.Session:
+        # cloudscraper is slow to import, a freetar serving from its cache may never need it
+        import cloudscraper
+        # keep cloudscraper's own https adapter (cipher suites, TLS context), a session is only
+        # used by one thread at a time, so it doesn't need a larger connection pool
+        return cloudscraper.create_scraper()
+
+    def _host_limit(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_limits[host]
+
+    def _checkout(self) -> requests.Session:
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                return self._sessions.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    return self._new_session()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.Timeout("No upstream session available")
+            # wake up now and then, a broken session frees its slot without returning to the queue
+            try:
+                return self._sessions.get(timeout=min(remaining, 0.1))
+            except queue.Empty:
+                pass
+
+    def _checkin(self, session: requests.Session, broken: bool = False):
+        if broken:
+            # the next checkout creates a fresh session in its place
+            session.close()
+            with self._lock:
+                self._created -= 1
+                self.replaced += 1
+            return
+        self._sessions.put(session)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", (self.connect_timeout, self.timeout))
+        host_limit = self._host_limit(urlparse(url).netloc)
+        if not host_limit.acquire(timeout=self.timeout):
+            raise requests.exceptions.Timeout(f"Too many concurrent requests to {urlparse(url).netloc}")
+        try:
+            session = self._checkout()
+            from cloudscraper.exceptions import CloudflareException
+            broken = False
+            try:
+                resp = session.get(url, **kwargs)
+                broken = resp.status_code == 403
+                return resp
+            except CloudflareException as e:
+                broken = True
+                raise requests.exceptions.ConnectionError(f"Cloudflare challenge failed: {e}") from e
+            finally:
+                self._checkin(session, broken)
+        finally:
+            host_limit.release()
+
+    def has_capacity(self) -> bool:
+        """Whether a request could get a session right now without waiting"""
+        return self._sessions.qsize() > 0 or self._created < self.size
+
+    def stats(self) -> dict:
+        return {"sessions": self._created,
+                "idle_sessions": self._sessions.qsize(),
+                "replaced_sessions": self.replaced}
+
+
+class CircuitBreaker:
+    """Stop calling upstream for a while after it failed repeatedly.
+
+    After `threshold` consecutive failures (403s, timeouts, ...) the breaker
+    opens and calls are refused for `cooldown` seconds. Then a single trial call
+    is let through: if it succeeds the breaker closes again, otherwise it stays
+    open for another cooldown.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 60):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "CircuitBreaker":
+        return cls(threshold=int(os.environ.get("FREETAR_BREAKER_THRESHOLD", "5")),
+                   cooldown=float(os.environ.get("FREETAR_BREAKER_COOLDOWN", "60")))
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            self.refused += 1
+            return False
+
+    def refuses(self) -> bool:
+        """Whether calls are refused until the cooldown is over, counted as a refused call
+
+        Unlike allow(), this doesn't claim the trial call of a half-open breaker.
+        """
+        with self._lock:
+            if self.state != "open":
+                return False
+            self.refused += 1
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def stats(self) -> dict:
+        return {"state": self.state,
+                "consecutive_failures": self.failures,
+                "refused_calls": self.refused}
+
+
+class TokenBucket:
+    """`rate` requests per second on average, bursts of up to `burst`. A rate of 0 means no limit"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available, 0 if there is one"""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+
+class UpstreamScheduler:
+    """Paces all requests to UG and decides who goes first.
+
+    A request needs a token from the global bucket and from the bucket of its
+    kind (tab, search). Waiting requests are served by priority, then in
+    order of arrival, skipping requests whose kind has no tokens left. A request
+    that waited longer than its deadline is dropped, its user has most likely
+    given up. The priority is set per thread with `priority()`, requests
+    default to INTERACTIVE.
+    """
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    PRIORITIES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+    def __init__(self,
+                 rate: float = 0,
+                 burst: float = 10,
+                 kind_rates: dict = None,
+                 deadlines: dict = None):
+        self.bucket = TokenBucket(rate, burst)
+        self.kind_buckets = {kind: TokenBucket(kind_rate, 2 * kind_rate)
+                             for kind, kind_rate in (kind_rates or {}).items()}
+        self.deadlines = deadlines or {self.INTERACTIVE: 10, self.BACKGROUND: 60}
+        self._waiting = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self.granted = {p: 0 for p in self.PRIORITIES}
+        self.dropped = {p: 0 for p in self.PRIORITIES}
+        self.wait_seconds_total = {p: 0.0 for p in self.PRIORITIES}
+        self.wait_seconds_max = {p: 0.0 for p in self.PRIORITIES}
+        self.max_queue_depth = 0
+
+    @classmethod
+    def from_env(cls) -> "UpstreamScheduler":
+        return cls(rate=float(os.environ.get("FREETAR_UPSTREAM_RATE", "10")),
+                   burst=float(os.environ.get("FREETAR_UPSTREAM_BURST", "20")),
+                   kind_rates={"tab": float(os.environ.get("FREETAR_UPSTREAM_RATE_TAB", "0")),
+                               "search": float(os.environ.get("FREETAR_UPSTREAM_RATE_SEARCH", "0"))},
+                   deadlines={cls.INTERACTIVE: float(os.environ.get("FREETAR_UPSTREAM_DEADLINE", "10")),
+                              cls.BACKGROUND: float(os.environ.get("FREETAR_UPSTREAM_BACKGROUND_DEADLINE", "60"))})
+
+    @contextmanager
+    def priority(self, priority: int):
+        """Requests made by this thread inside the block have this priority"""
+        previous = self.current_priority()
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def current_priority(self) -> int:
+        return getattr(self._local, "priority", self.INTERACTIVE)
+
+    def _delay(self, kind: str, now: float) -> float:
+        bucket = self.kind_buckets.get(kind)
+        return max(self.bucket.delay(now), bucket.delay(now) if bucket else 0.0)
+
+    def acquire(self, kind: str) -> float:
+        """Wait for the turn of a request of this kind, returns the seconds waited
+
+        Raises TimeoutError if the deadline passed first.
+        """
+        priority = self.current_priority()
+        start = time.monotonic()
+        deadline = start + self.deadlines[priority]
+        with self._cond:
+            self._seq += 1
+            waiter = (priority, self._seq, kind)
+            bisect.insort(self._waiting, waiter)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiting))
+            try:
+                while True:
+                    now = time.monotonic()
+                    wake = deadline
+                    for other in self._waiting:
+                        delay = self._delay(other[2], now)
+                        if delay == 0:
+                            break
+                        wake = min(wake, now + delay)
+                    else:
+                        other = None
+                    if other is waiter:
+                        self.bucket.take()
+                        if kind in self.kind_buckets:
+                            self.kind_buckets[kind].take()
+                        break
+                    if now >= deadline:
+                        self.dropped[priority] += 1
+                        raise TimeoutError(f"Waited {now - start:.1f}s for a request to UG")
+                    # someone else goes first, or no one can go yet
+                    self._cond.wait(wake - now if other is None else deadline - now)
+            finally:
+                self._waiting.remove(waiter)
+                self._cond.notify_all()
+            waited = time.monotonic() - start
+            self.granted[priority] += 1
+            self.wait_seconds_total[priority] += waited
+            self.wait_seconds_max[priority] = max(self.wait_seconds_max[priority], waited)
+        return waited
+
+    def stats(self) -> dict:
+        stats = {"queue_depth": len(self._waiting), "max_queue_depth": self.max_queue_depth}
+        for priority, name in self.PRIORITIES.items():
+            granted = self.granted[priority]
+            stats[name] = {"granted": granted,
+                           "dropped": self.dropped[priority],
+                           "wait_seconds_avg": round(self.wait_seconds_total[priority] / granted, 4)
+                           if granted else None,
+                           "wait_seconds_max": round(self.wait_seconds_max[priority], 4)}
+        return stats
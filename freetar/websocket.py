@@ -1,39 +1,68 @@
 import asyncio
 import json
-from typing import List, Dict
+import os
+import time
+from typing import Dict
 from datetime import datetime
 import uuid
 
+from freetar.metrics import registry
+
+# messages waiting to be sent to a single client, a client that falls further behind is disconnected
+MAX_QUEUED_MESSAGES = int(os.environ.get("FREETAR_WS_QUEUE", "16"))
+
+BROADCAST_SECONDS = registry.histogram("freetar_ws_broadcast_seconds",
+                                       "Time to serialize a broadcast and queue it for all clients")
+DELIVERY_SECONDS = registry.histogram("freetar_ws_delivery_seconds",
+                                      "Time from a broadcast until it was sent to a client")
+
+
 class Connection:
-    def __init__(self, websocket):
+    def __init__(self, websocket, queue_size: int = MAX_QUEUED_MESSAGES):
         self.websocket = websocket
         self.connected_at = datetime.now()
         self.id = str(uuid.uuid4())  # Unique identifier
-    
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.sender = None
+
     def __eq__(self, other):
         return isinstance(other, Connection) and self.id == other.id
-    
+
     def __hash__(self):
         return hash(self.id)
 
+
 class WebSocketManager:
-    def __init__(self):
-        self.connections: List[Connection] = []
-    
+    def __init__(self, queue_size: int = MAX_QUEUED_MESSAGES):
+        self.connections: Dict[str, Connection] = {}
+        self.queue_size = queue_size
+        self.broadcasts = 0
+        self.sent = 0
+        self.dropped = 0
+        self.slow_disconnects = 0
+        # time from broadcast() until a message was handed to the client's socket
+        self.fanout_seconds_total = 0.0
+        self.fanout_seconds_max = 0.0
+        # event loop of the websocket server, set once it runs
+        self.loop = None
+        # called with every share received from a client, to pass it on to other freetar processes
+        self.relay = None
+
     async def register(self, websocket):
-        connection = Connection(websocket)
-        self.connections.append(connection)
+        connection = Connection(websocket, self.queue_size)
+        self.connections[connection.id] = connection
+        connection.sender = asyncio.create_task(self._send_queued(connection))
         print(f"Client connected. Total connections: {len(self.connections)}")
         try:
             await self.handle_connection(connection)
         finally:
+            connection.sender.cancel()
             self._remove_connection(connection)
             print(f"Client disconnected. Total connections: {len(self.connections)}")
-    
+
     def _remove_connection(self, connection):
-        # Use ID-based removal to avoid comparison issues
-        self.connections = [conn for conn in self.connections if conn.id != connection.id]
-    
+        self.connections.pop(connection.id, None)
+
     async def handle_connection(self, connection):
         try:
             async for message in connection.websocket:
@@ -42,27 +71,80 @@ class WebSocketManager:
                     print(f"Broadcasting page share: {data['url']}")
                     # Broadcast to all other connections
                     await self.broadcast(data, exclude=connection)
+                    if self.relay is not None:
+                        await asyncio.get_running_loop().run_in_executor(None, self.relay, data)
         except Exception as e:
             print(f"Error handling connection: {e}")
-    
+
+    async def _send_queued(self, connection):
+        """Send the queued messages of one client, one after the other"""
+        while True:
+            message, queued_at = await connection.queue.get()
+            try:
+                await connection.websocket.send(message)
+            except Exception as e:
+                print(f"Error broadcasting to connection {connection.id}: {e}")
+                self._remove_connection(connection)
+                return
+            latency = time.perf_counter() - queued_at
+            DELIVERY_SECONDS.observe(latency)
+            self.sent += 1
+            self.fanout_seconds_total += latency
+            self.fanout_seconds_max = max(self.fanout_seconds_max, latency)
+
     async def broadcast(self, data: Dict, exclude: Connection = None):
-        # Create a copy of connections list to avoid modification during iteration
-        connections_copy = self.connections.copy()
-        successful_broadcasts = 0
-        
-        for conn in connections_copy:
+        """Queue a message for every client (except `exclude`)
+
+        The message is serialized once. Every client has its own queue and
+        sender task, so a slow client doesn't hold up the others. A client whose
+        queue is full misses the message and is disconnected.
+        """
+        with BROADCAST_SECONDS.time():
+            self._queue_broadcast(data, exclude)
+
+    def _queue_broadcast(self, data: Dict, exclude: Connection = None):
+        message = json.dumps(data)
+        queued_at = time.perf_counter()
+        self.broadcasts += 1
+        queued = 0
+
+        for conn in list(self.connections.values()):
             if exclude and conn.id == exclude.id:
                 continue
-                
             try:
-                await conn.websocket.send(json.dumps(data))
-                successful_broadcasts += 1
-            except Exception as e:
-                print(f"Error broadcasting to connection {conn.id}: {e}")
-                # Mark for removal by removing from original list
+                conn.queue.put_nowait((message, queued_at))
+                queued += 1
+            except asyncio.QueueFull:
+                self.dropped += 1
+                self.slow_disconnects += 1
+                print(f"Connection {conn.id} is too slow, disconnecting it")
                 self._remove_connection(conn)
-        
-        print(f"Successfully broadcasted to {successful_broadcasts} clients")
+                asyncio.ensure_future(conn.websocket.close(1013, "too slow"))
+
+        print(f"Successfully queued broadcast for {queued} clients")
+
+    def publish(self, data: Dict):
+        """Broadcast a message from another thread, e.g. a Flask view"""
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.broadcast(data), loop)
+
+    def stats(self) -> dict:
+        return {"connections": len(self.connections),
+                "broadcasts": self.broadcasts,
+                "sent_messages": self.sent,
+                "dropped_messages": self.dropped,
+                "slow_disconnects": self.slow_disconnects,
+                "fanout_seconds_avg": round(self.fanout_seconds_total / self.sent, 6) if self.sent else None,
+                "fanout_seconds_max": round(self.fanout_seconds_max, 6)}
+
+    def metrics(self):
+        yield "freetar_ws_connections", "gauge", "Connected websocket clients", {}, len(self.connections)
+        yield "freetar_ws_messages_sent_total", "counter", "Messages sent to websocket clients", {}, self.sent
+        yield ("freetar_ws_messages_dropped_total", "counter",
+               "Messages dropped because a client was too slow", {}, self.dropped)
+
 
 # Global WebSocket manager instance
-ws_manager = WebSocketManager() 
\ No newline at end of file
+ws_manager = WebSocketManager()
+registry.collector(ws_manager.metrics)
@@ -0,0 +1,21 @@
+import os
+import tempfile
+
+from benchmarks.stub_server import StubUG
+
+DATA_ROOT = tempfile.mkdtemp(prefix="freetar-test-")
+
+
+def pytest_configure(config):
+    # freetar reads its configuration at import time: point it at a local UG stand-in
+    # and let it keep its data in a temporary directory
+    stub = StubUG().start()
+    os.environ["FREETAR_UG_URL"] = stub.url
+    os.environ["FREETAR_UPSTREAM_RATE"] = "0"
+    os.environ["FREETAR_CACHE"] = "simple"
+    os.chdir(DATA_ROOT)
+
+
+def pytest_unconfigure(config):
+    # pytest goes back to where it started, freetar saves its state to ./data at exit
+    os.chdir(DATA_ROOT)
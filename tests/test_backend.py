@@ -0,0 +1,64 @@
+import time
+
+from freetar import backend
+from freetar.encoding import EncodedBody
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_stale_search_page_is_refreshed():
+    client = backend.app.test_client()
+    url = "/search?search_term=wonderwall&page=1"
+    assert client.get(url).status_code == 200
+    with backend.app.test_request_context(url):
+        key = backend.page_key(backend.request)
+    page, _ = backend.cache.get(key)
+    # stored long ago
+    backend.cache.set(key, (page, 0))
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert "Warning" in response.headers
+    wait_for(lambda: backend.cache.get(key)[1] > 0)
+    assert "Warning" not in client.get(url).headers
+
+
+def page_key(url: str) -> str:
+    with backend.app.test_request_context(url):
+        return backend.page_key(backend.request)
+
+
+def test_page_key_keeps_encoded_query_apart():
+    assert page_key("/search?search_term=x%26y%3Dz") != page_key("/search?search_term=x&y=z")
+    assert page_key("/search?page=2&search_term=x") == page_key("/search?search_term=x&page=2")
+
+
+def test_tab_page_key_ignores_query():
+    assert page_key("/tab/artist/song?junk=1") == page_key("/tab/artist/song")
+
+
+def test_legacy_page_entry_is_encoded_once(monkeypatch):
+    client = backend.app.test_client()
+    url = "/search?search_term=legacy"
+    key = page_key(url)
+    with backend.app.app_context():
+        backend.cache.set(key, "<html><body>  cached before pages were encoded  </body></html>")
+    encoded = []
+    monkeypatch.setattr(backend, "encode_page", lambda page: encoded.append(page) or EncodedBody(page.encode()))
+
+    for _ in range(2):
+        response = client.get(url)
+        assert b"cached before pages were encoded" in response.data
+    assert len(encoded) == 1
+    page, _ = backend.cache.get(key)
+    assert isinstance(page, EncodedBody)
+
+
+def test_page_tells_the_websocket_address():
+    # the default waitress mode serves websockets on the next port, not under /ws
+    assert b'data-server="waitress"' in backend.app.test_client().get("/about").data
@@ -0,0 +1,54 @@
+import os
+
+from freetar.cache import MemoryCache, SegmentedLRU
+
+
+def entry(size: int) -> tuple:
+    return b"", size
+
+
+def test_routes_evict_only_within_their_budget():
+    cache = MemoryCache(max_bytes=100_000, quotas={"tab": 50, "search": 50, "other": 0}, default_timeout=0)
+    tabs = {f"view//tab/artist/song-{n}": os.urandom(1000) for n in range(20)}
+    for key, value in tabs.items():
+        cache.set(key, value)
+    # a flood of searches, ten times the search budget
+    for n in range(500):
+        cache.set(f"view//search?search_term=song+{n}", os.urandom(1000))
+
+    assert all(cache.get(key) == value for key, value in tabs.items())
+    segments = cache.segments
+    assert segments["tab"].evictions == 0
+    assert segments["search"].evictions > 400
+    assert segments["search"].bytes <= segments["search"].max_bytes
+    # the newest searches are kept
+    assert cache.get("view//search?search_term=song+499") is not None
+    assert cache.get("view//search?search_term=song+0") is None
+
+
+def test_probation_entries_are_evicted_first():
+    lru = SegmentedLRU(max_bytes=10, protected_ratio=0.5)
+    for key in "abcde":
+        lru.put(key, entry(2))
+    # used again: protected
+    lru.get("a")
+    lru.get("b")
+    lru.put("f", entry(2))
+    lru.put("g", entry(2))
+    assert set(lru.protected) == {"a", "b"}
+    assert list(lru.probation) == ["e", "f", "g"]
+    assert lru.evictions == 2
+    assert lru.bytes == 10
+
+
+def test_replaced_entry_keeps_its_segment():
+    lru = SegmentedLRU(max_bytes=10, protected_ratio=0.5)
+    lru.put("a", entry(2))
+    lru.get("a")
+    lru.put("a", entry(3))
+    assert "a" in lru.protected
+    assert lru.protected_bytes == 3
+    lru.put("b", entry(2))
+    lru.put("b", entry(1))
+    assert "b" in lru.probation
+    assert lru.bytes == 4
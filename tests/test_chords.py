@@ -0,0 +1,18 @@
+import random
+
+from benchmarks import bench_chords
+from freetar import ug
+
+
+def test_get_chords_matches_legacy():
+    bench_chords.check_identical(samples=2000)
+
+
+def test_chord_shapes_are_memoized():
+    applicature = bench_chords.random_applicature(random.Random(1))
+    first = ug.get_chords(bench_chords._Song(applicature))
+    hits = ug.chord_shape.cache_info().hits
+    second = ug.get_chords(bench_chords._Song(applicature))
+    assert first == second
+    # the second tab with the same chords doesn't compute any shape again
+    assert ug.chord_shape.cache_info().hits > hits
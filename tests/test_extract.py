@@ -0,0 +1,26 @@
+from benchmarks import bench_extract
+from benchmarks.fixtures import search_pages, tab_pages
+from freetar import ug
+
+
+def test_fast_path_matches_beautifulsoup():
+    bench_extract.check_identical()
+
+
+def test_fast_path_matches_full_page_parse():
+    for page in tab_pages() + search_pages():
+        assert ug.extract_store(page) == bench_extract._full_soup(page)
+
+
+def test_single_quoted_attributes():
+    page = tab_pages()[0]
+    tweaked = page.replace('class="js-store"', "class='js-store'", 1)
+    assert ug._extract_store_fast(tweaked) == ug._extract_store_fast(page)
+
+
+def test_falls_back_to_beautifulsoup():
+    page = tab_pages()[0]
+    # the fast path only knows lower case tags
+    tweaked = page.replace('<div class="js-store"', '<DIV class="js-store"', 1)
+    assert ug._extract_store_fast(tweaked) is None
+    assert ug.extract_store(tweaked) == ug.extract_store(page)
@@ -0,0 +1,26 @@
+import threading
+
+from freetar.prefetch import Prefetcher
+
+
+def test_prefetches_submitted_paths():
+    warmed = []
+    done = threading.Event()
+
+    def warm(path):
+        warmed.append(path)
+        if len(warmed) == 2:
+            done.set()
+        return True
+
+    prefetcher = Prefetcher(warm, budget=10)
+    prefetcher.submit(["a", "b", "a"])
+    assert done.wait(5)
+    assert warmed == ["a", "b"]
+
+
+def test_budget_of_zero_disables_prefetching():
+    prefetcher = Prefetcher(lambda path: True, budget=0)
+    prefetcher.submit(["a", "b"])
+    assert prefetcher._thread is None
+    assert prefetcher.stats()["queued"] == 0
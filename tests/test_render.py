@@ -0,0 +1,19 @@
+from benchmarks import bench_render
+from benchmarks.fixtures import tab_data
+from freetar import ug
+
+
+def test_render_tab_matches_legacy_fix_tab():
+    bench_render.check_identical(samples=5000)
+
+
+def test_chord_markup():
+    assert bench_render.render("[ch]C#m7/G#[/ch]") == (
+        "<div class='tab-block'><span class=\"chord fw-bold\"><span class=\"chord-root\">C#</span>"
+        "<span class=\"chord-quality\">m7</span>/<span class=\"chord-bass\">G#</span></span></div>")
+
+
+def test_song_detail_uses_render_tab():
+    data = tab_data(verses=3)
+    content = data["store"]["page"]["data"]["tab_view"]["wiki_tab"]["content"]
+    assert ug.SongDetail(data).tab == bench_render.legacy_fix_tab(content)
@@ -0,0 +1,147 @@
+import json
+import os
+import random
+from datetime import datetime
+
+import pytest
+
+from freetar import store
+
+
+@pytest.fixture(autouse=True)
+def no_atexit(monkeypatch):
+    # stores that "crashed" must not save anything when the tests end
+    monkeypatch.setattr(store.atexit, "register", lambda fn: None)
+
+
+def favorites_store(tmp_path) -> store.FavoritesStore:
+    # the background thread never gets to sync or compact during a test
+    favorites = store.FavoritesStore(str(tmp_path / "favorites.json"), sync_interval=3600)
+    favorites.load()
+    return favorites
+
+
+def crash(favorites: store.FavoritesStore):
+    """Stop a store like a killed process would, with its journal synced"""
+    favorites.sync()
+    favorites._stop.set()
+    favorites._journal.close()
+
+
+def favorite(n: int) -> dict:
+    return {"artist_name": f"artist {n}", "song": f"song {n}"}
+
+
+def test_journal_is_replayed_without_snapshot(tmp_path):
+    favorites = favorites_store(tmp_path)
+    for n in range(5):
+        favorites.add(f"/tab/{n}", favorite(n))
+    favorites.remove("/tab/2")
+    crash(favorites)
+    assert not os.path.exists(favorites.path)
+
+    assert favorites_store(tmp_path).as_dict() == {f"/tab/{n}": favorite(n) for n in (0, 1, 3, 4)}
+
+
+def test_crash_between_journal_rotation_and_snapshot(tmp_path, monkeypatch):
+    favorites = favorites_store(tmp_path)
+    favorites.add("/tab/1", favorite(1))
+    favorites.compact()
+    favorites.add("/tab/2", favorite(2))
+    favorites.remove("/tab/1")
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(store.json, "dump", fail)
+        with pytest.raises(OSError):
+            favorites.compact()
+        favorites.add("/tab/3", favorite(3))
+        # a second failed snapshot adds to the old journal instead of replacing it
+        with pytest.raises(OSError):
+            favorites.compact()
+    favorites.add("/tab/4", favorite(4))
+    crash(favorites)
+    assert os.path.exists(favorites.journal_path + ".old")
+
+    expected = {f"/tab/{n}": favorite(n) for n in (2, 3, 4)}
+    recovered = favorites_store(tmp_path)
+    assert recovered.as_dict() == expected
+    # the next snapshot takes the old journal along
+    recovered.compact()
+    assert not os.path.exists(recovered.journal_path + ".old")
+    crash(recovered)
+    assert favorites_store(tmp_path).as_dict() == expected
+
+
+def test_compaction_keeps_removals(tmp_path):
+    favorites = favorites_store(tmp_path)
+    for n in range(3):
+        favorites.add(f"/tab/{n}", favorite(n))
+    favorites.compact()
+    favorites.remove("/tab/0")
+    favorites.compact()
+    favorites.remove("/tab/1")
+    crash(favorites)
+
+    with open(favorites.path) as f:
+        assert set(json.load(f)) == {"/tab/1", "/tab/2"}
+    assert favorites_store(tmp_path).as_dict() == {"/tab/2": favorite(2)}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def recent_shares(tmp_path, monkeypatch, capacity: int) -> store.RecentShares:
+    clock = Clock()
+    monkeypatch.setattr(store.time, "time", clock)
+    shares = store.RecentShares(str(tmp_path / "shares.json"), capacity=capacity, save_delay=3600)
+    shares.clock = clock
+    return shares
+
+
+def share(url: str, shared_at: float) -> dict:
+    return {"url": url, "timestamp": datetime.fromtimestamp(shared_at).isoformat()}
+
+
+def test_recent_shares_match_a_plain_list(tmp_path, monkeypatch):
+    rng = random.Random(4)
+    shares = recent_shares(tmp_path, monkeypatch, capacity=4)
+    # newest first, like the list freetar used to keep
+    model = []
+    for _ in range(500):
+        shares.clock.now += rng.choice((0, 0.5, 1, 3))
+        new = share(f"/tab/{rng.randrange(7)}", shares.clock.now)
+        shares.add(new)
+        model = [(new, shares.clock.now)] + [(s, t) for s, t in model if s["url"] != new["url"]]
+        del model[shares.capacity:]
+
+        assert shares.shares() == [s for s, _ in model]
+        assert len(shares) == len(model)
+        assert shares.latest() == model[0]
+        since = shares.clock.now - rng.choice((0, 1, 2, 5, 100))
+        assert shares.shares_since(since) == [s for s, t in model if t >= since]
+    assert shares.version == 500
+    shares._save_timer.cancel()
+
+
+def test_recent_shares_survive_save_and_load(tmp_path, monkeypatch):
+    shares = recent_shares(tmp_path, monkeypatch, capacity=5)
+    for n in range(12):
+        shares.clock.now += 60
+        shares.add(share(f"/tab/{n % 8}", shares.clock.now))
+    shares._save_timer.cancel()
+    shares.save()
+
+    loaded = store.RecentShares(shares.path, capacity=5)
+    loaded.load()
+    assert loaded.shares() == shares.shares()
+    assert loaded.latest() == shares.latest()
+    since = shares.clock.now - 150
+    assert loaded.shares_since(since) == shares.shares_since(since) != []
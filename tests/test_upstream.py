@@ -0,0 +1,82 @@
+import threading
+import time
+
+import pytest
+
+from freetar import ug
+from freetar.upstream import CircuitBreaker, UpstreamScheduler
+from freetar.utils import UpstreamUnavailable
+
+
+def wait_for_queue(scheduler: UpstreamScheduler, depth: int):
+    deadline = time.monotonic() + 5
+    while scheduler.stats()["queue_depth"] < depth:
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def request(scheduler: UpstreamScheduler, priority: int, kind: str, granted: list):
+    def run():
+        with scheduler.priority(priority):
+            scheduler.acquire(kind)
+        granted.append((scheduler.PRIORITIES[priority], kind))
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_interactive_requests_go_first():
+    scheduler = UpstreamScheduler(rate=5, burst=1)
+    scheduler.acquire("tab")
+    granted = []
+    threads = [request(scheduler, scheduler.BACKGROUND, "tab", granted)]
+    wait_for_queue(scheduler, 1)
+    threads.append(request(scheduler, scheduler.INTERACTIVE, "tab", granted))
+    wait_for_queue(scheduler, 2)
+    for thread in threads:
+        thread.join()
+    assert granted == [("interactive", "tab"), ("background", "tab")]
+
+
+def test_requests_of_a_kind_without_tokens_are_skipped():
+    scheduler = UpstreamScheduler(rate=0, kind_rates={"tab": 0.5})
+    scheduler.acquire("tab")
+    granted = []
+    tab = request(scheduler, scheduler.INTERACTIVE, "tab", granted)
+    wait_for_queue(scheduler, 1)
+    search = request(scheduler, scheduler.BACKGROUND, "search", granted)
+    search.join(timeout=1)
+    # the search didn't wait for the tab before it, which waits ~2 s for its token
+    assert granted == [("background", "search")]
+    tab.join()
+    assert granted[-1] == ("interactive", "tab")
+
+
+def test_requests_are_dropped_after_their_deadline():
+    scheduler = UpstreamScheduler(rate=0.1, burst=1, deadlines={UpstreamScheduler.INTERACTIVE: 0.05,
+                                                                UpstreamScheduler.BACKGROUND: 60})
+    scheduler.acquire("tab")
+    with pytest.raises(TimeoutError):
+        scheduler.acquire("tab")
+    stats = scheduler.stats()
+    assert stats["interactive"]["dropped"] == 1
+    assert stats["queue_depth"] == 0
+
+
+def test_refused_calls_are_counted_while_the_breaker_is_open(monkeypatch):
+    breaker = CircuitBreaker(threshold=1, cooldown=60)
+    monkeypatch.setattr(ug, "breaker", breaker)
+    breaker.failure()
+    for _ in range(2):
+        with pytest.raises(UpstreamUnavailable):
+            ug.fetch(f"{ug.UG_URL}/search.php", "search")
+    assert breaker.stats()["refused_calls"] == 2
+
+
+def test_open_breaker_check_leaves_the_trial_call():
+    breaker = CircuitBreaker(threshold=1, cooldown=0)
+    breaker.failure()
+    assert breaker.state == "half-open"
+    assert not breaker.refuses()
+    assert breaker.allow()
+    assert not breaker.allow()
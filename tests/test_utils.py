@@ -0,0 +1,75 @@
+import threading
+import time
+
+from freetar.utils import SingleFlight
+
+CALLERS = 8
+
+
+def call_concurrently(flight: SingleFlight, fn):
+    """Call `fn` through `flight` from CALLERS threads at once, returns the threads and
+    the list their results (or exceptions) go to"""
+    outcomes = [None] * CALLERS
+    waiting = threading.Barrier(CALLERS + 1)
+
+    def run(n):
+        waiting.wait()
+        try:
+            outcomes[n] = flight.do("key", fn)
+        except Exception as e:
+            outcomes[n] = e
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(CALLERS)]
+    for thread in threads:
+        thread.start()
+    waiting.wait()
+    return threads, outcomes
+
+
+def wait_for_waiters(flight: SingleFlight):
+    deadline = time.monotonic() + 5
+    while flight.coalesced < CALLERS - 1:
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_concurrent_calls_share_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return object()
+
+    threads, outcomes = call_concurrently(flight, fetch)
+    # let everybody join the running call before it returns
+    wait_for_waiters(flight)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert all(outcome is outcomes[0] for outcome in outcomes)
+    assert flight.stats() == {"upstream_calls": 1, "coalesced_calls": CALLERS - 1}
+    assert not flight._calls
+
+
+def test_exception_reaches_every_caller():
+    flight = SingleFlight()
+    release = threading.Event()
+    error = ValueError("UG is down")
+
+    def fetch():
+        release.wait(5)
+        raise error
+
+    threads, outcomes = call_concurrently(flight, fetch)
+    wait_for_waiters(flight)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert all(outcome is error for outcome in outcomes)
+    assert not flight._calls
+    # the next call runs again
+    assert flight.do("key", lambda: 42) == 42